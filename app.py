@@ -1,40 +1,146 @@
 #!/usr/bin/env python3
 
-from sqlalchemy import create_engine, asc
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm.exc import NoResultFound
 from database_setup import Base, User, Category, Item
+from db import REPLICA_STICKY_SECONDS, Session, engine, pick_replica
+from db import replicas
+from cache import LRUCache, add_cache_tags, cache, cached, conditional
+from cache import page_versions, render_fragment
+from queries import get_catalog_stats, get_category, get_item
+from queries import get_item_page, get_item_with_relations
+from queries import CATEGORY_COLUMNS, ITEM_COLUMNS, serialize_rows
+from search import search_items
+from batch import BatchError
+from migrations import LATEST_VERSION, current_version
+from sessions import make_session_interface, regenerate
+from ratelimit import CHEAP, LOW, HIGH, rate_limit
+from popularity import counts_views
+import metrics
 from flask import flash, make_response
 from flask import session as login_session
 from flask import Flask, render_template, request, redirect, jsonify, url_for
-
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.client import FlowExchangeError
-
-import httplib2
+from flask import Response
+from jinja2 import FileSystemBytecodeCache
+
+import assets
+import batch
+import changes
+import compress
+import fastjson
+import datetime
+import oauth
+import popularity
+import ratelimit
+import os
 import random
 import string
 import json
-import requests
+import tempfile
+import time
 
 
 app = Flask(__name__)
 
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
+# Compiled templates survive restarts, so workers skip compiling them.
+JINJA_CACHE_DIR = os.environ.get(
+    'CATALOG_JINJA_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'catalog-jinja-cache'))
+
+# Logged-in users' profiles, by id and by email.
+user_cache = LRUCache(
+    max_entries=int(os.environ.get('CATALOG_USER_CACHE_SIZE', 10000)),
+    ttl=int(os.environ.get('CATALOG_USER_CACHE_TTL', 3600)))
+
+
+def create_app():
+    """Configure the app for serving and return it
+
+    Importing this module does no I/O; metrics, the template cache and
+    the session store are set up here, once. The schema is never touched:
+    create or upgrade it with ``python database_setup.py``.
+    """
+
+    if app.config.get('CATALOG_CONFIGURED'):
+        return app
+
+    metrics.init_app(app, engine)
+    for replica in replicas:
+        metrics.instrument_engine(replica)
+    metrics.gauges['catalog_cache'] = cache.stats
+    metrics.gauges['catalog_user_cache'] = user_cache.stats
+
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+    assets.init_app(app)
+    compress.init_app(app)
+    ratelimit.init_app(app)
+    metrics.gauges['catalog_admission'] = ratelimit.monitor.stats
+    metrics.gauges['catalog_views'] = popularity.tracker.stats
+
+    # Pages showing the popular items change when the ranking does.
+    # Ranked now, so the first pages' ETags match the ranking they show;
+    # each process starts its flush thread on the first request.
+    popularity.tracker.refresh()
+    for endpoint in ('home', 'show_items_in_category'):
+        page_versions[endpoint] = popularity.tracker.ranking_version
+
+    session_interface = make_session_interface(
+        os.environ.get('CATALOG_SESSION_STORE', 'database'), engine)
+    if session_interface is not None:
+        app.session_interface = session_interface
+
+    secret_key = os.environ.get('CATALOG_SECRET_KEY')
+    if secret_key:
+        app.secret_key = secret_key
+
+    app.config['CATALOG_CONFIGURED'] = True
+    return app
+
+# Page sizes for the HTML listings and the JSON API.
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Rows fetched per round trip by the streaming export.
+EXPORT_BATCH_SIZE = 1000
 
 # DB handler code
-engine = create_engine(
-    'sqlite:///catalog.db',
-    connect_args={
-        'check_same_thread': False
-    }
-)
+# `session` proxies to a separate Session for every request thread.
+session = Session
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Roll back and return the request's session to the pool"""
+
+    session.remove()
+
+
+@app.before_request
+def route_reads():
+    """Read from a replica on GET, unless this user has just written"""
+
+    if replicas and request.method in ('GET', 'HEAD') and \
+            login_session.get('read_primary_until', 0) < time.time():
+        session.info['replica'] = pick_replica()
+
 
-# Bind engine to a session.
-Session = sessionmaker(bind=engine)
+@app.after_request
+def stick_to_primary(response):
+    """After a commit, read this user's pages from the primary for a while"""
 
-# Create a Session object.
-session = Session()
+    if replicas and session.info.get('committed'):
+        read_own_writes()
+    return response
+
+
+def read_own_writes():
+    if 'user_id' in login_session:
+        login_session['read_primary_until'] = \
+            time.time() + REPLICA_STICKY_SECONDS
 
 # end of db handler code
 
@@ -42,13 +148,28 @@ session = Session()
 @app.route('/')
 @app.route('/catalog/')
 @app.route('/catalog/items/')
+@rate_limit('120/minute')
+@conditional
+@cached('items', 'categories')
 def home():
     """Landing Page"""
 
-    categories = session.query(Category).all()
-    items = session.query(Item).all()
+    limit, after = page_args()
+
+    def load_items():
+        items, next_cursor = get_item_page(session.query(Item), limit, after)
+        return dict(
+            items=items, limit=limit, after=after, next_cursor=next_cursor)
+
     return render_template(
-        'index.html', categories=categories, items=items)
+        'index.html',
+        popular_items=popularity.tracker.popular_items(),
+        category_list=render_fragment(
+            '_category_list.html',
+            '',
+            lambda: dict(categories=session.query(Category).all())),
+        item_list=render_fragment(
+            '_item_list.html', (limit, after), load_items))
 
 # login endpoint
 @app.route('/login/')
@@ -58,11 +179,13 @@ def login():
     state = ''.join(random.choice(string.ascii_uppercase + string.digits)
                     for x in range(32))
     login_session['state'] = state
-    return render_template("login.html", STATE=state, client_id=CLIENT_ID)
+    return render_template(
+        "login.html", STATE=state, client_id=oauth.client_id())
 
 
 # Connect to Google Sign-in OAuth method.
 @app.route('/gconnect', methods=['POST'])
+@rate_limit('30/minute', cost=LOW)
 def gconnect():
 
     if request.args.get('state') != login_session['state']:
@@ -72,10 +195,12 @@ def gconnect():
 
     code = request.data
 
+    # Only the login views need oauth2client.
+    from oauth2client.client import FlowExchangeError
+
     try:
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
+        with metrics.timed_http():
+            credentials = oauth.exchange_code(code)
 
     except FlowExchangeError:
         response = make_response(
@@ -85,11 +210,9 @@ def gconnect():
 
         return response
 
-    # Check if access token is valid or not
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s' % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+    # Check if access token is valid or not, fetching user info alongside
+    with metrics.timed_http():
+        result, data = oauth.validate_token(credentials.access_token)
 
     # If error - return
     if result.get('error') is not None:
@@ -107,7 +230,7 @@ def gconnect():
         return response
 
     # Verify access token application validity
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != oauth.client_id():
         response = make_response(
             json.dumps("Token's client ID does not match with application."), 401)
         print("Token's client ID mismatch with application")
@@ -123,20 +246,15 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
+    # A new session id for the logged-in user, so one planted before
+    # login cannot follow them.
+    regenerate(login_session)
+
     # Store token in the session
     login_session['access_token'] = credentials.access_token
     login_session['google_id'] = google_id
 
     # user info.
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {
-        'access_token': credentials.access_token,
-        'alt': 'json'
-    }
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
-
     if "name" in data:
         login_session['username'] = data['name']
     else:
@@ -179,11 +297,10 @@ def gdisconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
+    with metrics.timed_http():
+        revoked = oauth.revoke_token(access_token)
 
-    if result['status'] == '200':
+    if revoked:
         response = make_response(json.dumps('Successfully disconnected.'), 200)
         response.headers['Content-Type'] = 'application/json'
 
@@ -209,6 +326,7 @@ def logout():
         del login_session['user_id']
         del login_session['google_id']
         del login_session['username']
+        regenerate(login_session)
 
         flash("You have been successfully logged out!")
         return redirect(url_for('home'))
@@ -228,27 +346,43 @@ def create_user(login_session):
     )
 
     session.add(new_user)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        # Another request registered the same email first.
+        session.rollback()
+        user_cache.delete('email:' + login_session['email'])
+        return get_user_id(login_session['email'])
 
-    user = session.query(User).filter_by(email=login_session['email']).one()
-    return user.id
+    user_cache.delete('email:' + new_user.email)
+    return new_user.id
 
 
 def get_user_info(user_id):
     """Get user info"""
 
-    user = session.query(User).filter_by(id=user_id).one()
+    user = user_cache.get('id:%d' % user_id)
+    if user is None:
+        user = session.query(User).filter_by(id=user_id).one()
+        # Detach it so the cached copy outlives this request's session.
+        session.expunge(user)
+        user_cache.set('id:%d' % user_id, user)
     return user
 
 
 def get_user_id(email):
     """Get user by email id"""
 
+    user_id = user_cache.get('email:' + email)
+    if user_id is not None:
+        return user_id
+
     try:
         user = session.query(User).filter_by(email=email).one()
-        return user.id
-    except:
+    except NoResultFound:
         return None
+    user_cache.set('email:' + email, user.id)
+    return user.id
 
 
 # Add a new category.
@@ -264,17 +398,18 @@ def add_category():
             flash('The field cannot be empty.')
             return redirect(url_for('home'))
 
-        category = session.query(Category).\
-            filter_by(name=request.form['new-category-name']).first()
-        if category is not None:
-            flash('Entered category already exists.')
-            return redirect(url_for('add_category'))
-
         new_category = Category(
             name=request.form['new-category-name'],
             user_id=login_session['user_id'])
         session.add(new_category)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            flash('Entered category already exists.')
+            return redirect(url_for('add_category'))
+
+        cache.invalidate('categories')
         flash('New Category %s created!' % new_category.name)
         return redirect(url_for('home'))
     else:
@@ -298,13 +433,14 @@ def add_item():
 
         new_item = Item(
             name=request.form['name'],
-            category_id=request.form['category'],
+            category_id=request.form.get('category', type=int),
             description=request.form['description'],
             user_id=login_session['user_id']
         )
 
         session.add(new_item)
         session.commit()
+        cache.invalidate('items')
 
         flash('New item successfully created!')
         return redirect(url_for('home'))
@@ -349,6 +485,7 @@ def add_item_by_category(category_id):
 
         session.add(new_item)
         session.commit()
+        cache.invalidate('items')
 
         flash('New item successfully created!')
         return redirect(
@@ -359,49 +496,36 @@ def add_item_by_category(category_id):
         )
 
     else:
-        category = session.query(Category).filter_by(id=category_id).first()
+        category = get_category(category_id)
         return render_template('new-item-2.html', category=category)
 
 
-# Check if item exists
-def exists_item(item_id):
-    """Check if item exists"""
+# Keyset pagination arguments
+def page_args(default=PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    """Read the `limit` and `after` cursor arguments of a listing"""
 
-    item = session.query(Item).filter_by(id=item_id).first()
-    if item is not None:
-        return True
-    else:
-        return False
-
-
-# Check if the category exists
-def exists_category(category_id):
-    """Check if category existsthe database"""
-
-    category = session.query(Category).filter_by(id=category_id).first()
-    if category is not None:
-        return True
-    else:
-        return False
+    limit = request.args.get('limit', default, type=int)
+    limit = max(1, min(limit, maximum))
+    after = request.args.get('after', type=int)
+    return limit, after
 
 
 # View item by ID
 @app.route('/catalog/item/<int:item_id>/')
+@counts_views
+@conditional
+@cached('item:{item_id}')
 def view_item(item_id):
     """View item by ID"""
 
-    if exists_item(item_id):
-        item = session.query(Item).filter_by(id=item_id).first()
-        category = session.query(Category)\
-            .filter_by(id=item.category_id).first()
-
-        owner = session.query(User).filter_by(id=item.user_id).first()
-
+    item = get_item_with_relations(item_id)
+    if item is not None:
+        add_cache_tags('category:%d' % item.category_id)
         return render_template(
             "view-item.html",
             item=item,
-            category=category,
-            owner=owner
+            category=item.category,
+            owner=item.user
         )
 
     else:
@@ -418,11 +542,11 @@ def edit_item(item_id):
         flash("Please log in to continue.")
         return redirect(url_for('login'))
 
-    if not exists_item(item_id):
+    item = get_item(item_id)
+    if item is None:
         flash("Unable to process request")
         return redirect(url_for('home'))
 
-    item = session.query(Item).filter_by(id=item_id).first()
     if login_session['user_id'] != item.user_id:
         flash("Not Authorised to access this page.")
         return redirect(url_for('home'))
@@ -433,10 +557,11 @@ def edit_item(item_id):
         if request.form['description']:
             item.description = request.form['description']
         if request.form['category']:
-            item.category_id = request.form['category']
+            item.category_id = request.form.get('category', type=int)
 
         session.add(item)
         session.commit()
+        cache.invalidate('items', 'item:%d' % item_id)
 
         flash('Item successfully updated!')
         return redirect(url_for('edit_item', item_id=item_id))
@@ -461,11 +586,11 @@ def delete_item(item_id):
         flash("Please log in to continue.")
         return redirect(url_for('login'))
 
-    if not exists_item(item_id):
+    item = get_item(item_id)
+    if item is None:
         flash("Unable to process request!")
         return redirect(url_for('home'))
 
-    item = session.query(Item).filter_by(id=item_id).first()
     if login_session['user_id'] != item.user_id:
         flash("Not Authorised to access this page.")
         return redirect(url_for('home'))
@@ -473,6 +598,7 @@ def delete_item(item_id):
     if request.method == 'POST':
         session.delete(item)
         session.commit()
+        cache.invalidate('items', 'item:%d' % item_id)
 
         flash("Item deleted!")
         return redirect(url_for('home'))
@@ -483,22 +609,70 @@ def delete_item(item_id):
 
 # Show items in particular category.
 @app.route('/catalog/category/<int:category_id>/items/')
+@conditional
 def show_items_in_category(category_id):
     """# Show items in particular category."""
 
-    if not exists_category(category_id):
+    category = get_category(category_id)
+    if category is None:
         flash("Unaable to process request!")
         return redirect(url_for('home'))
 
-    category = session.query(Category).filter_by(id=category_id).first()
-    items = session.query(Item).filter_by(category_id=category.id).all()
-    total = session.query(Item).filter_by(category_id=category.id).count()
+    limit, after = page_args()
+
+    def load_items():
+        items, next_cursor = get_item_page(
+            session.query(Item).filter_by(category_id=category_id),
+            limit,
+            after)
+        return dict(
+            category=category,
+            items=items,
+            limit=limit,
+            after=after,
+            next_cursor=next_cursor)
 
     return render_template(
         'items.html',
         category=category,
-        items=items,
-        total=total)
+        total=category.item_count,
+        popular_items=popularity.tracker.popular_items(category_id),
+        item_list=render_fragment(
+            '_category_item_list.html',
+            (category_id, limit, after),
+            load_items))
+
+
+# Search items
+@app.route('/catalog/search/')
+@rate_limit('60/minute', cost=HIGH)
+@conditional
+def search():
+    """Search item names and descriptions"""
+
+    terms = request.args.get('q', '')
+    category_id = request.args.get('category_id', type=int)
+    limit, page = search_args(PAGE_SIZE, MAX_PAGE_SIZE)
+    items = search_items(terms, category_id, limit, page)
+
+    return render_template(
+        'search.html',
+        terms=terms,
+        category_id=category_id,
+        categories=session.query(Category).all(),
+        items=items[:limit],
+        limit=limit,
+        page=page,
+        has_next=len(items) > limit)
+
+
+def search_args(default, maximum):
+    """Read the `limit` and `page` arguments of a search"""
+
+    limit = request.args.get('limit', default, type=int)
+    limit = max(1, min(limit, maximum))
+    page = max(1, request.args.get('page', 1, type=int))
+    return limit, page
 
 
 # Edit exiting category
@@ -506,13 +680,13 @@ def show_items_in_category(category_id):
 def edit_category(category_id):
     """Edit existing category"""
 
-    category = session.query(Category).filter_by(id=category_id).first()
+    category = get_category(category_id)
 
     if 'username' not in login_session:
         flash("Please log in to continue.")
         return redirect(url_for('login'))
 
-    if not exists_category(category_id):
+    if category is None:
         flash("Unable to process request!")
         return redirect(url_for('home'))
 
@@ -524,7 +698,15 @@ def edit_category(category_id):
         if request.form['name']:
             category.name = request.form['name']
             session.add(category)
-            session.commit()
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                flash('Entered category already exists.')
+                return redirect(
+                    url_for('edit_category', category_id=category_id))
+
+            cache.invalidate('categories', 'category:%d' % category_id)
             flash('Category updated!')
             return redirect(
                 url_for(
@@ -542,12 +724,12 @@ def edit_category(category_id):
 def delete_category(category_id):
     """Delete category"""
 
-    category = session.query(Category).filter_by(id=category_id).first()
+    category = get_category(category_id)
     if 'username' not in login_session:
         flash("Please log in to continue.")
         return redirect(url_for('login'))
 
-    if not exists_category(category_id):
+    if category is None:
         flash("Unable to process request!")
         return redirect(url_for('home'))
 
@@ -558,51 +740,288 @@ def delete_category(category_id):
     if request.method == 'POST':
         session.delete(category)
         session.commit()
+        cache.invalidate('categories', 'category:%d' % category_id, 'items')
         flash("Category deleted!")
         return redirect(url_for('home'))
     else:
         return render_template("delete_category.html", category=category)
 
 
+# Health checks
+@app.route('/healthz')
+@rate_limit(None, cost=CHEAP)
+def healthz():
+    """Liveness: the process is up and serving requests"""
+
+    return jsonify(status='ok')
+
+
+@app.route('/readyz')
+@rate_limit(None, cost=CHEAP)
+def readyz():
+    """Readiness: not draining, and the database answers with a current schema"""
+
+    if app.config.get('DRAINING'):
+        return jsonify(status='draining'), 503
+    try:
+        with engine.connect() as connection:
+            version = current_version(connection)
+    except SQLAlchemyError:
+        return jsonify(status='database unavailable'), 503
+    if version < LATEST_VERSION:
+        return jsonify(status='schema out of date', version=version), 503
+    return jsonify(status='ok', version=version)
+
+
+# Prometheus metrics
+@app.route('/metrics')
+@rate_limit(None, cost=CHEAP)
+def show_metrics():
+    """Return request, SQL, template and HTTP timings"""
+
+    return Response(
+        metrics.expose(), mimetype='text/plain; version=0.0.4')
+
+
 # JSON Endpoints
 
+@app.route('/api/v1/cache/stats')
+def cache_stats_json():
+    """Return response cache counters"""
+
+    return jsonify(cache=cache.stats())
+
+
 @app.route('/api/v1/catalog.json')
+@rate_limit('60/minute', cost=HIGH)
+@conditional
+@cached('items')
 def show_catalog_json():
-    """Return items as JSON"""
+    """Return a page of items as JSON"""
+
+    limit, after = page_args(API_PAGE_SIZE, API_MAX_PAGE_SIZE)
+    items, next_cursor = get_item_page(
+        session.query(*ITEM_COLUMNS), limit, after)
+
+    next_url = None
+    if next_cursor is not None:
+        next_url = url_for(
+            'show_catalog_json', limit=limit, after=next_cursor)
+
+    return fastjson.jsonify(
+        catalog=serialize_rows(items),
+        next_cursor=next_cursor,
+        next=next_url)
+
+
+# Stream the whole catalog
+@app.route('/api/v1/catalog/export')
+@rate_limit('10/hour', cost=HIGH)
+def export_catalog():
+    """Stream every item as NDJSON or as one chunked JSON document"""
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'json'):
+        return jsonify(error='Unknown export format.'), 400
+
+    category_id = request.args.get('category_id', type=int)
+    updated_since = request.args.get('updated_since')
+    if updated_since is not None:
+        try:
+            updated_since = datetime.datetime.fromisoformat(updated_since)
+        except ValueError:
+            return jsonify(
+                error='updated_since must be an ISO 8601 timestamp.'), 400
+
+    # The stream outlives the request, so it reads through its own
+    # session rather than the request-scoped one, from wherever
+    # route_reads() sent this request's reads: the primary for a while
+    # after this user wrote.
+    export_session = Session.session_factory()
+    export_session.info['replica'] = session.info.get('replica')
+    items = export_session.query(*(ITEM_COLUMNS + (Item.updated_at,)))
+    if category_id is not None:
+        items = items.filter(Item.category_id == category_id)
+    if updated_since is not None:
+        items = items.filter(Item.updated_at >= updated_since)
+    items = items.order_by(Item.id).yield_per(EXPORT_BATCH_SIZE)
+
+    if export_format == 'ndjson':
+        mimetype = 'application/x-ndjson'
+    else:
+        mimetype = 'application/json'
+    return Response(
+        stream_export(export_session, items, export_format == 'ndjson'),
+        mimetype=mimetype)
+
 
-    items = session.query(Item).order_by(Item.id.desc())
-    return jsonify(catalog=[i.serialize for i in items])
+def stream_export(export_session, items, ndjson):
+    """Yield serialized items one at a time as they are fetched"""
+
+    try:
+        if not ndjson:
+            yield '{"catalog":['
+        keys = None
+        for n, item in enumerate(items):
+            if keys is None:
+                keys = item.keys()
+            row = dict(zip(keys, item))
+            row['updated_at'] = (
+                item.updated_at.isoformat() if item.updated_at else None)
+            if ndjson:
+                yield json.dumps(row) + '\n'
+            else:
+                yield (',' if n else '') + json.dumps(row)
+        if not ndjson:
+            yield ']}'
+    finally:
+        export_session.close()
+
+
+# Search items
+@app.route('/api/v1/search')
+@rate_limit('60/minute', cost=HIGH)
+@conditional
+def search_json():
+    """Return a page of ranked search results as JSON"""
+
+    terms = request.args.get('q', '')
+    category_id = request.args.get('category_id', type=int)
+    limit, page = search_args(API_PAGE_SIZE, API_MAX_PAGE_SIZE)
+    items = search_items(terms, category_id, limit, page)
+
+    next_url = None
+    if len(items) > limit:
+        next_url = url_for(
+            'search_json',
+            q=terms,
+            category_id=category_id,
+            limit=limit,
+            page=page + 1)
+
+    return fastjson.jsonify(
+        results=[i.serialize for i in items[:limit]],
+        next=next_url)
 
 
 # Return particular item
 @app.route('/api/v1/categories/<int:category_id>/item/<int:item_id>/JSON')
+@conditional
 def catalog_item_json(category_id, item_id):
     """Return particular item"""
 
-    if exists_category(category_id) and exists_item(item_id):
-        item = session.query(Item)\
-               .filter_by(id=item_id, category_id=category_id).first()
-        if item is not None:
-            return jsonify(item=item.serialize)
-        else:
-            return jsonify(
-                error='Ttem {} does not belong to category {}.'
-                .format(item_id, category_id))
+    item = get_item(item_id)
+    if item is not None and item.category_id == category_id:
+        return jsonify(item=item.serialize)
+    elif item is not None and get_category(category_id) is not None:
+        return jsonify(
+            error='Ttem {} does not belong to category {}.'
+            .format(item_id, category_id))
     else:
         return jsonify(error='Item or Category does not exist!')
 
 
+# Batch writes
+@app.route('/api/v1/batch', methods=['POST'])
+@rate_limit('30/minute', cost=HIGH)
+def batch_json():
+    """Create, update and delete items and categories in one request"""
+
+    if 'username' not in login_session:
+        return jsonify(error='Please log in to continue.'), 401
+
+    payload = request.get_json(silent=True)
+    try:
+        status, mode, results = batch.run(
+            engine, payload, login_session['user_id'])
+    except BatchError as e:
+        return jsonify(error=str(e)), 400
+    except IntegrityError:
+        return jsonify(error='Batch conflicts with a concurrent change.'), 409
+
+    if status != 422:
+        if replicas:
+            read_own_writes()
+        tags = ['items', 'categories']
+        for op, result in zip(payload['operations'], results):
+            if result['status'] == 'ok' and op['op'] != 'create':
+                tags.append('%s:%d' % (op['type'], op['id']))
+        cache.invalidate(*tags)
+    return jsonify(mode=mode, results=results), status
+
+
+# Change feed
+@app.route('/api/v1/changes')
+def changes_json():
+    """Return item and category changes after `since`, oldest first"""
+
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', API_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, API_MAX_PAGE_SIZE))
+    page = changes.read_changes(session, since, limit)
+    last_seq = page[-1]['seq'] if page else since
+
+    next_url = None
+    if len(page) == limit:
+        next_url = url_for('changes_json', since=last_seq, limit=limit)
+
+    return fastjson.jsonify(changes=page, last_seq=last_seq, next=next_url)
+
+
+@app.route('/api/v1/changes/stream')
+@rate_limit('10/minute', cost=LOW)
+def change_stream():
+    """Stream changes as Server-Sent Events, resuming after Last-Event-ID"""
+
+    # Each stream holds this request thread; beyond the limit clients
+    # should poll /api/v1/changes, or use a server running asgi.py.
+    if changes.feed.full() or changes.feed.closed:
+        return jsonify(error='Too many live streams; poll /api/v1/changes.'),\
+            503, {'Retry-After': '30'}
+
+    since = request.args.get('since', type=int)
+    if since is None:
+        since = request.headers.get('Last-Event-ID', type=int)
+    return Response(
+        changes.stream(changes.feed, since),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'})
+
+
+# Catalog statistics
+@app.route('/api/v1/stats')
+@rate_limit(cost=LOW)
+def stats_json():
+    """Return catalog totals, or one user's item count"""
+
+    user_id = request.args.get('user_id', type=int)
+    if user_id is not None:
+        user = session.query(User.item_count).filter_by(id=user_id).first()
+        if user is None:
+            return jsonify(error='User does not exist!'), 404
+        return jsonify(user_id=user_id, items=user.item_count)
+
+    stats = get_catalog_stats()
+    if stats is None:
+        return jsonify(items=0, categories=0, users=0)
+    return jsonify(
+        items=stats.items, categories=stats.categories, users=stats.users)
+
+
 # Return categories
 @app.route('/api/v1/categories/JSON')
+@conditional
+@cached('categories')
 def categories_json():
     """Return categories"""
 
-    categories = session.query(Category).all()
-    return jsonify(categories=[i.serialize for i in categories])
+    categories = session.query(*CATEGORY_COLUMNS).all()
+    return fastjson.jsonify(categories=serialize_rows(categories))
 
 
 if __name__ == "__main__":
     print('Starting Application')
+    create_app()
     app.secret_key = b'$pV4BVvmVZaM9*CV2WD#RYcjH#-k*LaqVCy7-mP4F!n!PRRdZs++cMdt7eg!T6pBH!#LbaWCsR%KYg!gWPYZBBG%-Utf#AhbucW5'
     app.run(host="0.0.0.0", port=5000, debug=True)
 
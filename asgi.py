@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""Serve the catalog from an ASGI server.
+
+    uvicorn asgi:app
+    python asgi.py --port 8000
+
+The Flask views and templates run unchanged on a bounded thread pool.
+The event loop does all of the client I/O: it reads request bodies,
+writes responses and waits on slow or idle connections. A thread (and
+the database connection its session holds) is only taken for the time
+a view actually runs, so one process can serve many more concurrent
+clients than it has threads.
+
+Login and logout wait on Google's OAuth endpoints, which the loop
+cannot do for them, so they run on a pool of their own
+(CATALOG_ASGI_OAUTH_THREADS): slow round trips there never leave the
+other views without threads.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import asyncio
+import io
+import os
+import sys
+
+# Threads available to run views; each may hold one pooled connection.
+ASGI_THREADS = int(os.environ.get('CATALOG_ASGI_THREADS', 16))
+
+# Threads for the views making outbound OAuth calls.
+OAUTH_THREADS = int(os.environ.get('CATALOG_ASGI_OAUTH_THREADS', 8))
+OAUTH_PATHS = ('/gconnect', '/logout')
+
+
+def wsgi_environ(scope, body):
+    """Build a WSGI environ from an ASGI http scope and request body"""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI carries paths as latin-1 decoded bytes.
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8')
+        .decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+class WsgiToAsgi(object):
+    """ASGI application running a WSGI app on a thread pool"""
+
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, on_shutdown=None,
+                 routes=None, slow_paths=(), slow_threads=OAUTH_THREADS):
+        self.wsgi_app = wsgi_app
+        # Paths served by native ASGI apps instead of the WSGI app.
+        self.routes = routes or {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='asgi-view')
+        # Paths whose views block on other services get their own pool.
+        self.slow_paths = frozenset(slow_paths)
+        self.slow_executor = ThreadPoolExecutor(
+            max_workers=slow_threads, thread_name_prefix='asgi-slow')
+        self.on_shutdown = on_shutdown
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] in self.routes:
+            await self.routes[scope['path']](scope, receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else:
+            raise ValueError('Unsupported ASGI scope: ' + scope['type'])
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Let running views finish before closing the pool.
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self.executor.shutdown)
+                await loop.run_in_executor(
+                    None, self.slow_executor.shutdown)
+                if self.on_shutdown is not None:
+                    self.on_shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+            return lambda data: None
+
+        if scope['path'] in self.slow_paths:
+            executor = self.slow_executor
+        else:
+            executor = self.executor
+        loop = asyncio.get_event_loop()
+        run = loop.run_in_executor
+        result = await run(executor, self.wsgi_app,
+                           wsgi_environ(scope, b''.join(body)),
+                           start_response)
+        chunks = iter(result)
+        try:
+            if isinstance(result, (list, tuple)):
+                async def pull():
+                    return next(chunks, None)
+            else:
+                # Streamed bodies are produced on the pool one chunk
+                # at a time; the thread is free while the client reads.
+                async def pull():
+                    return await run(executor, next, chunks, None)
+
+            # The first chunk is pulled before the headers are sent, for
+            # apps that only call start_response once iterated.
+            chunk = await pull()
+            await send({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': started['headers'],
+            })
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body',
+                                'body': chunk, 'more_body': True})
+                chunk = await pull()
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await run(executor, result.close)
+
+
+def make_app():
+    """Wrap the Flask app, flushing view counts and closing pooled
+    connections on shutdown"""
+
+    from app import create_app
+    from changes import asgi_stream
+    from db import engine
+    from popularity import tracker
+
+    def on_shutdown():
+        tracker.stop()
+        engine.dispose()
+
+    # Idle change streams wait on the event loop, not on a thread.
+    return WsgiToAsgi(
+        create_app().wsgi_app, on_shutdown=on_shutdown,
+        routes={'/api/v1/changes/stream': asgi_stream},
+        slow_paths=OAUTH_PATHS)
+
+
+app = make_app()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('python asgi.py needs uvicorn: pip install uvicorn')
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""Fingerprinted static assets.
+
+    python assets.py build
+
+copies every file in static/ to static/dist/ under a name containing a
+hash of its content (style.css -> dist/style.3f2a9c1e0b7d.css), writes
+.gz (and, with the brotli package, .br) variants next to compressible
+files, and records the names in static/dist/manifest.json.
+
+Templates link assets with ``asset_url('style.css')``, which resolves
+through the manifest and falls back to the plain file before a build.
+Hashed files never change, so they are served with an immutable one-year
+cache lifetime, and precompressed variants are picked by Accept-Encoding.
+"""
+
+from flask import request, send_from_directory, url_for
+
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import shutil
+import sys
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.html', '.json', '.txt', '.map')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Variants in order of preference: (encoding, suffix).
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+_manifest = None
+_manifest_lock = threading.Lock()
+
+
+def fingerprint(path):
+    with io.open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def build(static_dir=STATIC_DIR):
+    """Write hashed copies, compressed variants and the manifest"""
+
+    dist = os.path.join(static_dir, DIST)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            stem, ext = os.path.splitext(relative)
+            hashed = '{}.{}{}'.format(stem, fingerprint(source), ext)
+            target = os.path.join(dist, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+            if ext in COMPRESSIBLE:
+                compress_file(target)
+            manifest[relative] = DIST + '/' + hashed
+    os.makedirs(dist, exist_ok=True)
+    with io.open(os.path.join(dist, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def compress_file(path):
+    with io.open(path, 'rb') as f:
+        data = f.read()
+    # mtime=0 keeps the .gz bytes reproducible between builds.
+    with io.open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with io.open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+
+
+def manifest():
+    """Return the build's name -> hashed name map, read once"""
+
+    global _manifest
+    if _manifest is None:
+        with _manifest_lock:
+            if _manifest is None:
+                try:
+                    with io.open(os.path.join(STATIC_DIR, DIST, MANIFEST),
+                                 encoding='utf-8') as f:
+                        _manifest = json.load(f)
+                except (IOError, ValueError):
+                    _manifest = {}
+    return _manifest
+
+
+def asset_url(filename):
+    """URL of the hashed build of a static file, if one was built"""
+
+    return url_for('static', filename=manifest().get(filename, filename))
+
+
+def serve_static(filename):
+    """Serve static files; hashed ones immutable and precompressed"""
+
+    if not filename.startswith(DIST + '/'):
+        return send_from_directory(STATIC_DIR, filename)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        if request.accept_encodings[encoding] and \
+                os.path.isfile(os.path.join(STATIC_DIR, filename + suffix)):
+            response = send_from_directory(
+                STATIC_DIR, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(STATIC_DIR, filename)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+
+def init_app(app):
+    app.add_template_global(asset_url)
+    app.view_functions['static'] = serve_static
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['build']:
+        sys.exit('usage: python assets.py build')
+    for name, hashed in sorted(build().items()):
+        print('{} -> {}'.format(name, hashed))
@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+"""Batch create/update/delete of items and categories.
+
+A batch is validated as a whole (ownership, references, duplicate names
+against the database and within the batch) and then applied in one
+transaction with bulk statements. In ``atomic`` mode any invalid
+operation rejects the batch; in ``best_effort`` mode only the valid
+operations are applied.
+"""
+
+from collections import Counter
+from sqlalchemy import bindparam, text
+from database_setup import Category, Item
+from database_setup import apply_count_deltas, bump_catalog_version
+from database_setup import change_row
+from changes import log_batch
+
+import datetime
+
+MAX_OPERATIONS = 20000
+MODES = ('atomic', 'best_effort')
+
+# Stay well under SQLite's bound parameter limit in IN (...) lookups.
+CHUNK_SIZE = 500
+
+# From this many item writes on, the full-text index is updated with one
+# executemany per kind of write instead of a trigger call per row.
+BULK_SEARCH_INDEX = 1000
+
+SEARCH_TRIGGERS = ('item_fts_insert', 'item_fts_update', 'item_fts_delete')
+
+# catalog_stats column counting each kind.
+TOTALS = {'item': 'items', 'category': 'categories'}
+
+FIELDS = {
+    'item': {'name': 80, 'description': 250, 'category_id': None},
+    'category': {'name': 50},
+}
+
+
+class BatchError(ValueError):
+    """The batch request itself is malformed"""
+
+
+def chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def fetch_rows(connection, table, column, values, *columns):
+    """Return {value: row} for rows whose `column` is in `values`"""
+
+    # An expanding parameter compiles the query once, not per chunk.
+    query = table.select().with_only_columns(
+        [table.c[column]] + [table.c[c] for c in columns])\
+        .where(table.c[column].in_(bindparam('values', expanding=True)))
+    rows = {}
+    for chunk in chunks(set(values)):
+        for row in connection.execute(query, values=chunk):
+            rows[row[0]] = row
+    return rows
+
+
+def parse(payload):
+    """Return (mode, operations) from a request body"""
+
+    if not isinstance(payload, dict):
+        raise BatchError('Expected a JSON object.')
+    mode = payload.get('mode', 'atomic')
+    if mode not in MODES:
+        raise BatchError('mode must be one of: ' + ', '.join(MODES))
+    operations = payload.get('operations')
+    if not isinstance(operations, list) or not operations:
+        raise BatchError('operations must be a non-empty list.')
+    if len(operations) > MAX_OPERATIONS:
+        raise BatchError(
+            'At most {} operations per batch.'.format(MAX_OPERATIONS))
+    return mode, operations
+
+
+def is_integer(value):
+    # JSON true and false decode to bools, which are ints in Python.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def check_shape(op):
+    """Return an error message for a malformed operation, or None"""
+
+    if not isinstance(op, dict):
+        return 'Operation must be an object.'
+    if op.get('type') not in FIELDS:
+        return 'type must be item or category.'
+    if op.get('op') not in ('create', 'update', 'delete'):
+        return 'op must be create, update or delete.'
+    if op['op'] != 'create' and not is_integer(op.get('id')):
+        return 'id is required.'
+    if op['op'] == 'delete':
+        return None
+
+    data = op.get('data')
+    if not isinstance(data, dict) or not data:
+        return 'data is required.'
+    fields = FIELDS[op['type']]
+    unknown = set(data) - set(fields)
+    if unknown:
+        return 'Unknown fields: ' + ', '.join(sorted(unknown))
+    if op['op'] == 'create':
+        missing = [f for f in fields if f != 'description' and not data.get(f)]
+        if missing:
+            return 'Missing fields: ' + ', '.join(missing)
+    for field, limit in fields.items():
+        value = data.get(field)
+        if field == 'category_id':
+            if field in data and not is_integer(value):
+                return 'category_id must be an integer.'
+        elif field in data:
+            if not isinstance(value, str) or (field == 'name' and not value):
+                return '{} must be a non-empty string.'.format(field)
+            if len(value) > limit:
+                return '{} is longer than {} characters.'.format(field, limit)
+    return None
+
+
+def validate(connection, operations, user_id):
+    """Return a list with an error message (or None) per operation"""
+
+    errors = [check_shape(op) for op in operations]
+    valid = [(n, op) for n, op in enumerate(operations) if errors[n] is None]
+
+    def fail(n, message):
+        if errors[n] is None:
+            errors[n] = message
+
+    # Rows referenced by id, loaded in bulk.
+    ids = {'item': set(), 'category': set()}
+    names = {'item': Counter(), 'category': Counter()}
+    # Each row may be changed once per batch: the bulk statements and
+    # the count deltas assume it.
+    targets = Counter()
+    deleted_categories = set()
+    for n, op in valid:
+        if op['op'] != 'create':
+            ids[op['type']].add(op['id'])
+            targets[op['type'], op['id']] += 1
+        if op['op'] == 'delete' and op['type'] == 'category':
+            deleted_categories.add(op['id'])
+        data = op.get('data') or {}
+        if 'name' in data:
+            names[op['type']][data['name']] += 1
+        if op['type'] == 'item' and 'category_id' in data:
+            ids['category'].add(data['category_id'])
+
+    # Every serialized column, so the change log needs no second read.
+    items = fetch_rows(connection, Item.__table__, 'id', ids['item'],
+                       *SERIALIZED['item'][1])
+    categories = fetch_rows(connection, Category.__table__, 'id',
+                            ids['category'], *SERIALIZED['category'][1])
+    taken = {
+        'item': fetch_rows(connection, Item.__table__, 'name',
+                           names['item'], 'id'),
+        'category': fetch_rows(connection, Category.__table__, 'name',
+                               names['category'], 'id'),
+    }
+
+    for n, op in valid:
+        kind = op['type']
+        existing = items if kind == 'item' else categories
+        data = op.get('data') or {}
+        if op['op'] != 'create':
+            if targets[kind, op['id']] > 1:
+                fail(n, 'Duplicate id in batch: {} {}'.format(kind, op['id']))
+                continue
+            row = existing.get(op['id'])
+            if row is None:
+                fail(n, '{} {} does not exist.'.format(kind, op['id']))
+                continue
+            if row['user_id'] != user_id:
+                fail(n, 'Not authorised to change {} {}.'.format(
+                    kind, op['id']))
+                continue
+        if 'name' in data:
+            if names[kind][data['name']] > 1:
+                fail(n, 'Duplicate name in batch: ' + data['name'])
+            row = taken[kind].get(data['name'])
+            if row is not None and row['id'] != op.get('id'):
+                fail(n, '{} already exists: {}'.format(
+                    kind.title(), data['name']))
+        if 'category_id' in data and data['category_id'] not in categories:
+            fail(n, 'category {} does not exist.'.format(data['category_id']))
+        elif data.get('category_id') in deleted_categories:
+            fail(n, 'category {} is deleted in this batch.'.format(
+                data['category_id']))
+
+    return errors, {'item': items, 'category': categories}
+
+
+def apply(connection, operations, user_id, old_rows):
+    """Apply validated operations in bulk; return created ids by index"""
+
+    now = datetime.datetime.utcnow()
+    grouped = {}
+    for n, op in operations:
+        grouped.setdefault((op['type'], op['op']), []).append((n, op))
+
+    item_writes = sum(len(grouped.get(('item', action), ()))
+                      for action in ('create', 'update', 'delete'))
+    triggers = {}
+    if item_writes >= BULK_SEARCH_INDEX:
+        triggers = suspend_search_triggers(connection)
+
+    category_deltas, user_deltas, totals = Counter(), Counter(), Counter()
+    created = {}
+
+    for kind, table in (('category', Category.__table__),
+                        ('item', Item.__table__)):
+        creates = grouped.get((kind, 'create'), [])
+        if creates:
+            rows = []
+            for n, op in creates:
+                row = dict(op['data'], user_id=user_id)
+                if kind == 'item':
+                    row.setdefault('description', None)
+                    row['updated_at'] = now
+                    category_deltas[row['category_id']] += 1
+                    user_deltas[user_id] += 1
+                rows.append(row)
+            connection.execute(table.insert(), rows)
+            totals[TOTALS[kind]] += len(rows)
+            # Names were checked unique, so they identify the new rows.
+            new_ids = fetch_rows(connection, table, 'name',
+                                 [op['data']['name'] for n, op in creates],
+                                 'id')
+            for n, op in creates:
+                created[n] = new_ids[op['data']['name']]['id']
+
+        updates = grouped.get((kind, 'update'), [])
+        # One executemany per distinct set of changed columns.
+        by_columns = {}
+        for n, op in updates:
+            by_columns.setdefault(tuple(sorted(op['data'])), []).append(op)
+        for columns, ops in by_columns.items():
+            values = dict((c, bindparam('new_' + c)) for c in columns)
+            if kind == 'item':
+                values['updated_at'] = now
+            params = []
+            for op in ops:
+                params.append(dict(
+                    [('row_id', op['id'])] +
+                    [('new_' + c, op['data'][c]) for c in columns]))
+                if 'category_id' in columns:
+                    category_deltas[
+                        old_rows['item'][op['id']]['category_id']] -= 1
+                    category_deltas[op['data']['category_id']] += 1
+            connection.execute(
+                table.update().where(table.c.id == bindparam('row_id'))
+                .values(**values),
+                params)
+
+    # Delete items before the categories they may belong to.
+    for kind, table in (('item', Item.__table__),
+                        ('category', Category.__table__)):
+        deletes = [op['id'] for n, op in grouped.get((kind, 'delete'), [])]
+        for chunk in chunks(deletes):
+            connection.execute(table.delete().where(table.c.id.in_(chunk)))
+        totals[TOTALS[kind]] -= len(deletes)
+        if kind == 'item':
+            for item_id in deletes:
+                category_deltas[
+                    old_rows['item'][item_id]['category_id']] -= 1
+                user_deltas[user_id] -= 1
+
+    if triggers:
+        index_items(connection, grouped, created, old_rows['item'])
+        for sql in triggers.values():
+            connection.execute(sql)
+
+    apply_count_deltas(connection, category_deltas, user_deltas, totals)
+    bump_catalog_version(connection)
+    log_batch(connection,
+              change_rows(grouped, created, old_rows, user_id, now))
+    return created
+
+
+def suspend_search_triggers(connection):
+    """Drop the full-text triggers inside the batch's transaction
+
+    Returns their SQL, to recreate them before the transaction commits.
+    run() holds the write lock from its first statement, so the drop
+    rolls back with a failed batch and no other writer runs without the
+    triggers.
+    """
+
+    if connection.dialect.name != 'sqlite':
+        return {}
+    triggers = dict(connection.execute(
+        text("SELECT name, sql FROM sqlite_master "
+             "WHERE type = 'trigger' AND name IN :names")
+        .bindparams(bindparam('names', expanding=True)),
+        names=list(SEARCH_TRIGGERS)).fetchall())
+    for name in triggers:
+        connection.execute('DROP TRIGGER ' + name)
+    return triggers
+
+
+def index_items(connection, grouped, created, old_items):
+    """Do the suspended triggers' work on item_fts in bulk"""
+
+    removed, added = [], []
+    for n, op in grouped.get(('item', 'delete'), []):
+        removed.append(dict(old_items[op['id']]))
+    for n, op in grouped.get(('item', 'update'), []):
+        # Like the trigger: only writes to indexed columns count.
+        if 'name' in op['data'] or 'description' in op['data']:
+            old = dict(old_items[op['id']])
+            removed.append(old)
+            added.append(dict(old, **op['data']))
+    for n, op in grouped.get(('item', 'create'), []):
+        added.append({'id': created[n], 'name': op['data']['name'],
+                      'description': op['data'].get('description')})
+
+    if removed:
+        connection.execute(
+            text("INSERT INTO item_fts (item_fts, rowid, name, description) "
+                 "VALUES ('delete', :id, :name, :description)"),
+            removed)
+    if added:
+        connection.execute(
+            text("INSERT INTO item_fts (rowid, name, description) "
+                 "VALUES (:id, :name, :description)"),
+            added)
+
+
+# Columns of each kind's `serialize`, in order.
+SERIALIZED = {
+    'item': (Item.__table__, ('name', 'description', 'user_id',
+                              'category_id')),
+    'category': (Category.__table__, ('name', 'user_id')),
+}
+
+
+def change_rows(grouped, created, old_rows, user_id, now):
+    """Return change log rows for the applied operations, in request order
+
+    Each row is written at most once per batch, so its new state is the
+    row read by validate() with the operation's data applied.
+    """
+
+    rows = []
+    for kind, (_, columns) in SERIALIZED.items():
+        for n, op in grouped.get((kind, 'create'), []):
+            data = dict.fromkeys(('id',) + columns)
+            data.update(op['data'], id=created[n], user_id=user_id)
+            rows.append((n, change_row(kind, created[n], 'create', data, now)))
+        for n, op in grouped.get((kind, 'update'), []):
+            data = dict(old_rows[kind][op['id']])
+            data.update(op['data'])
+            rows.append((n, change_row(kind, op['id'], 'update', data, now)))
+        for n, op in grouped.get((kind, 'delete'), []):
+            rows.append((n, change_row(kind, op['id'], 'delete', None, now)))
+    return [row for n, row in sorted(rows, key=lambda r: r[0])]
+
+
+def begin_write(connection):
+    """Take SQLite's write lock before the first statement
+
+    pysqlite only opens a transaction before DML, so validate()'s reads
+    and the trigger DDL would otherwise run, and autocommit, outside it.
+    """
+
+    if connection.dialect.name == 'sqlite':
+        connection.execute('BEGIN IMMEDIATE')
+
+
+def run(engine, payload, user_id):
+    """Validate and apply a batch; return (status, mode, results)"""
+
+    mode, operations = parse(payload)
+    with engine.begin() as connection:
+        begin_write(connection)
+        errors, old_rows = validate(connection, operations, user_id)
+        failed = any(e is not None for e in errors)
+        if failed and mode == 'atomic':
+            return 422, mode, results(operations, errors, {}, applied=False)
+
+        valid = [(n, op) for n, op in enumerate(operations)
+                 if errors[n] is None]
+        created = apply(connection, valid, user_id, old_rows) if valid \
+            else {}
+    return 207 if failed else 200, mode, results(
+        operations, errors, created, applied=True)
+
+
+def results(operations, errors, created, applied):
+    """Per-operation outcome, in request order"""
+
+    out = []
+    for n, error in enumerate(errors):
+        if error is not None:
+            out.append({'index': n, 'status': 'error', 'error': error})
+        elif not applied:
+            out.append({'index': n, 'status': 'skipped'})
+        else:
+            result = {'index': n, 'status': 'ok'}
+            if n in created:
+                result['id'] = created[n]
+            elif isinstance(operations[n], dict) and 'id' in operations[n]:
+                result['id'] = operations[n]['id']
+            out.append(result)
+    return out
@@ -0,0 +1,932 @@
+#!/usr/bin/env python3
+
+"""Reproducible benchmarks for the catalog app.
+
+    python benchmark.py seed --scale 100000
+    python benchmark.py micro --scale 100000
+    python benchmark.py load --scale 100000 --threads 8 --duration 20
+    python benchmark.py concurrency --scale 100000 --clients 200
+    python benchmark.py startup --repeat 20
+    python benchmark.py serialize --scale 100000 --repeat 5
+    python benchmark.py queries --scale 100000
+    python benchmark.py scaling --scale 100000 --duration 5
+    python benchmark.py search --scale 1000000 --repeat 50
+
+Each scale gets its own seeded SQLite database under ``bench/``. Results
+are printed and saved as JSON under ``bench_results/`` together with the
+current commit, so runs can be compared between commits.
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import inspect
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+BENCH_DIR = 'bench'
+RESULTS_DIR = 'bench_results'
+SEED = 1234
+
+# p99 a search must stay under, in milliseconds.
+SEARCH_P99_TARGET_MS = 20
+
+# Searches of the search run: common words, prefixes, several words, a
+# rare name, a category, and no match; words from import_catalog.py.
+SEARCHES = [
+    ('board', None),
+    ('carbon ski', None),
+    ('alp', None),
+    ('pro edge car', None),
+    ('Racing wax 1', None),
+    ('board', 1),
+    ('helmet glo', 1),
+    ('zzzz', None),
+]
+
+# Least speedup of the scaling run's most threads over its fewest, when
+# statements have a round trip to wait out.
+MIN_SPEEDUP = 1.5
+
+# Most SQL statements each page may run with empty caches; the queries
+# run fails when one runs more. The catalog version read counts: every
+# page makes it.
+QUERY_BUDGETS = {
+    'home': 3,
+    'show_items_in_category': 3,
+    'view_item': 2,
+    'catalog_item_json': 2,
+}
+
+
+def database_path(scale):
+    return os.path.join(BENCH_DIR, 'catalog-{}.db'.format(scale))
+
+
+def use_database(path):
+    """Point the app at a benchmark database; call before importing it"""
+
+    os.environ['CATALOG_DATABASE_URL'] = 'sqlite:///' + os.path.abspath(path)
+    # Measure capacity, not admission control.
+    os.environ.setdefault('CATALOG_RATE_LIMIT_STORE', 'off')
+    os.environ.setdefault('CATALOG_SHED_MAX_IN_FLIGHT', '0')
+    os.environ.setdefault('CATALOG_SHED_P99_MS', '0')
+
+
+def seed(scale):
+    """Create the seeded dataset for `scale` items if it is missing"""
+
+    path = database_path(scale)
+    # Load in a child process so this one has not bound an engine yet.
+    env = dict(os.environ)
+    env['CATALOG_DATABASE_URL'] = 'sqlite:///' + os.path.abspath(path)
+    if os.path.exists(path):
+        # Seeded by an older commit: bring its schema up to date.
+        subprocess.check_call(
+            [sys.executable, 'migrations.py'], stdout=sys.stderr, env=env)
+        return
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    feed = path + '.ndjson'
+    with io.open(feed, 'w', encoding='utf-8') as out:
+        subprocess.check_call(
+            [sys.executable, 'import_catalog.py', 'generate', str(scale),
+             '--categories', str(max(1, scale // 1000)),
+             '--users', str(max(1, scale // 100)),
+             '--seed', str(SEED)],
+            stdout=out, env=env)
+    subprocess.check_call(
+        [sys.executable, 'import_catalog.py', 'load', feed,
+         '--restart', '--defer-search-index'],
+        stdout=sys.stderr, env=env)
+    os.remove(feed)
+
+
+def percentiles(samples):
+    """Return count, mean and p50/p95/p99 of latencies in milliseconds"""
+
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+
+    def pick(p):
+        return round(samples[min(len(samples) - 1,
+                                 int(p / 100.0 * len(samples)))] * 1000, 3)
+
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+        'p50_ms': pick(50),
+        'p95_ms': pick(95),
+        'p99_ms': pick(99),
+    }
+
+
+def timeit(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+
+def micro(repeat):
+    """Time the query, serialization and render paths in isolation"""
+
+    import app
+    from database_setup import Category, Item
+    from markupsafe import Markup
+
+    session = app.Session()
+    items = session.query(Item).order_by(Item.id.desc()).limit(1000).all()
+    categories = session.query(Category).all()
+    results = {
+        'query_item_page': timeit(
+            lambda: session.query(Item).order_by(Item.id.desc())
+            .limit(app.PAGE_SIZE).all(), repeat),
+        'item_serialize_1000': timeit(
+            lambda: [i.serialize for i in items], repeat),
+        'category_serialize_all': timeit(
+            lambda: [c.serialize for c in categories], repeat),
+    }
+
+    app.create_app().secret_key = 'benchmark'
+    with app.app.test_request_context('/'):
+        page = items[:app.PAGE_SIZE]
+
+        def render_home():
+            return app.render_template(
+                'index.html',
+                category_list=Markup(app.render_template(
+                    '_category_list.html', categories=categories)),
+                item_list=Markup(app.render_template(
+                    '_item_list.html', items=page, limit=app.PAGE_SIZE,
+                    after=None, next_cursor=None)))
+
+        results['home_render'] = timeit(render_home, repeat)
+
+    # The home() view body without its response caches, with its
+    # shared fragments rebuilt every time and then reused.
+    home_view = inspect.unwrap(app.home)
+    with app.app.test_request_context('/'):
+        results['home_view_cold_fragments'] = timeit(
+            lambda: (app.cache.clear(), home_view()), repeat)
+        results['home_view_cached_fragments'] = timeit(home_view, repeat)
+    app.Session.remove()
+    return results
+
+
+class Driver(threading.Thread):
+    """Issue weighted requests through a private test client"""
+
+    def __init__(self, app_module, routes, deadline, user_id, rng):
+        threading.Thread.__init__(self)
+        self.app = app_module
+        self.routes = routes
+        self.deadline = deadline
+        self.user_id = user_id
+        self.rng = rng
+        self.samples = {}
+        self.errors = {}
+
+    def run(self):
+        client = self.app.app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = 'benchmark'
+            session['user_id'] = self.user_id
+        names = [r[0] for r in self.routes]
+        weights = [r[1] for r in self.routes]
+        calls = dict((r[0], r[2]) for r in self.routes)
+        while time.time() < self.deadline:
+            name = self.rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            response = calls[name](client, self.rng)
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 500:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            self.samples.setdefault(name, []).append(elapsed)
+
+
+def routes(max_item_id, max_category_id, own_items, own_category):
+    """Return (name, weight, call) for every read and write route
+
+    Edits go to `own_items` and `own_category`, which belong to the
+    drivers' user, so they are timed as writes rather than as "not
+    authorised" redirects. Deletes only remove what the batch route
+    created; until it has, they load the confirmation page.
+    """
+
+    created_items = collections.deque()
+    created_categories = collections.deque()
+
+    def item_id(rng):
+        return rng.randint(1, max_item_id)
+
+    def category_id(rng):
+        return rng.randint(1, max_category_id)
+
+    def new_item(client, rng):
+        return client.post('/catalog/item/new/', data={
+            'name': 'bench item {}'.format(rng.random()),
+            'description': 'benchmark',
+            'category': category_id(rng)})
+
+    def new_item_in_category(client, rng):
+        return client.post(
+            '/catalog/category/{}/item/new/'.format(category_id(rng)), data={
+                'name': 'bench item {}'.format(rng.random()),
+                'description': 'benchmark'})
+
+    def edit_item(client, rng):
+        return client.post(
+            '/catalog/item/{}/edit/'.format(rng.choice(own_items)), data={
+                'name': '', 'description': 'edited {}'.format(rng.random()),
+                'category': ''})
+
+    def delete_item(client, rng):
+        try:
+            return client.post(
+                '/catalog/item/{}/delete/'.format(created_items.popleft()))
+        except IndexError:
+            return client.get(
+                '/catalog/item/{}/delete/'.format(rng.choice(own_items)))
+
+    def new_category(client, rng):
+        return client.post('/catalog/category/new/', data={
+            'new-category-name': 'bench {}'.format(rng.random())})
+
+    def edit_category(client, rng):
+        return client.post(
+            '/catalog/category/{}/edit/'.format(own_category), data={
+                'name': 'bench category {}'.format(rng.random())})
+
+    def delete_category(client, rng):
+        try:
+            return client.post('/catalog/category/{}/delete/'.format(
+                created_categories.popleft()))
+        except IndexError:
+            return client.get(
+                '/catalog/category/{}/delete/'.format(own_category))
+
+    def batch_write(client, rng):
+        # An empty category, so that deleting it later succeeds.
+        response = client.post('/api/v1/batch', json={'operations': [
+            {'type': 'category', 'op': 'create',
+             'data': {'name': 'bench batch {}'.format(rng.random())}},
+            {'type': 'item', 'op': 'create',
+             'data': {'name': 'bench batch item {}'.format(rng.random()),
+                      'description': 'benchmark',
+                      'category_id': own_category}},
+        ]})
+        if response.status_code == 200:
+            category, item = response.get_json()['results']
+            created_categories.append(category['id'])
+            created_items.append(item['id'])
+        return response
+
+    def export(client, rng):
+        response = client.get('/api/v1/catalog/export?category_id={}'.format(
+            category_id(rng)))
+        # Streamed: the rows are only read as the body is.
+        response.get_data()
+        return response
+
+    return [
+        ('home', 30, lambda c, r: c.get('/')),
+        ('home_page_2', 5, lambda c, r: c.get('/?after={}'.format(
+            max_item_id - 20))),
+        ('view_item', 20, lambda c, r: c.get(
+            '/catalog/item/{}/'.format(item_id(r)))),
+        ('category_items', 10, lambda c, r: c.get(
+            '/catalog/category/{}/items/'.format(category_id(r)))),
+        ('search', 5, lambda c, r: c.get('/catalog/search/?q=alp')),
+        ('api_catalog', 10, lambda c, r: c.get('/api/v1/catalog.json')),
+        ('api_categories', 5, lambda c, r: c.get('/api/v1/categories/JSON')),
+        ('api_item', 5, lambda c, r: c.get(
+            '/api/v1/categories/{}/item/{}/JSON'.format(
+                category_id(r), item_id(r)))),
+        ('api_search', 3, lambda c, r: c.get('/api/v1/search?q=board')),
+        ('api_export', 1, export),
+        ('api_changes', 3, lambda c, r: c.get('/api/v1/changes')),
+        ('api_stats', 3, lambda c, r: c.get('/api/v1/stats')),
+        ('add_item', 2, new_item),
+        ('add_item_by_category', 1, new_item_in_category),
+        ('edit_item', 2, edit_item),
+        ('delete_item', 1, delete_item),
+        ('add_category', 1, new_category),
+        ('edit_category', 1, edit_category),
+        ('delete_category', 1, delete_category),
+        ('batch_write', 2, batch_write),
+    ]
+
+
+def load(threads, duration, read_only):
+    """Drive every route from `threads` threads for `duration` seconds"""
+
+    import app
+    from database_setup import Category, Item
+
+    app.create_app().secret_key = 'benchmark'
+    session = app.Session()
+    max_item_id = session.query(Item.id).order_by(Item.id.desc()).first()[0]
+    max_category_id = session.query(Category.id)\
+        .order_by(Category.id.desc()).first()[0]
+    # Drivers log in as the owner of the first category, and edit it
+    # and their own items.
+    own_category, user_id = session.query(Category.id, Category.user_id)\
+        .order_by(Category.id).first()
+    own_items = [i for i, in session.query(Item.id)
+                 .filter(Item.user_id == user_id).limit(1000)]
+    app.Session.remove()
+
+    table = routes(max_item_id, max_category_id, own_items, own_category)
+    if read_only:
+        table = [r for r in table if not r[0].startswith(
+            ('add_', 'edit_', 'delete_', 'batch_'))]
+
+    deadline = time.time() + duration
+    drivers = [Driver(app, table, deadline, user_id, random.Random(SEED + n))
+               for n in range(threads)]
+    started = time.time()
+    for driver in drivers:
+        driver.start()
+    for driver in drivers:
+        driver.join()
+    elapsed = time.time() - started
+
+    merged = {}
+    for driver in drivers:
+        for name, samples in driver.samples.items():
+            merged.setdefault(name, []).extend(samples)
+    total = sum(len(s) for s in merged.values())
+    errors = {}
+    for driver in drivers:
+        for name, count in driver.errors.items():
+            errors[name] = errors.get(name, 0) + count
+    return {
+        'threads': threads,
+        'duration_s': round(elapsed, 3),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 1),
+        'errors': sum(errors.values()),
+        'errors_by_route': errors,
+        'overall': percentiles([x for s in merged.values() for x in s]),
+        'routes': dict((name, percentiles(samples))
+                       for name, samples in sorted(merged.items())),
+    }
+
+
+class IsolationDriver(threading.Thread):
+    """Write as one user through a private test client, checking that
+    no request leaves state behind for the next"""
+
+    def __init__(self, app_module, user_id, category, requests, tag):
+        threading.Thread.__init__(self)
+        self.app = app_module
+        self.user_id = user_id
+        self.category = category
+        self.requests = requests
+        self.prefix = 'isolation {} {} '.format(tag, user_id)
+        self.errors = 0
+        self.leaks = []
+
+    def run(self):
+        client = self.app.app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = 'benchmark'
+            session['user_id'] = self.user_id
+        for n in range(self.requests):
+            response = client.post('/catalog/item/new/', data={
+                'name': self.prefix + str(n),
+                'description': 'isolation',
+                'category': self.category.id})
+            self.errors += response.status_code >= 500
+            # A failed commit, which must not break the next request.
+            response = client.post('/catalog/category/new/', data={
+                'new-category-name': self.category.name})
+            self.errors += response.status_code >= 500
+            if self.app.Session.registry.has():
+                self.leaks.append('database session outlived its request')
+                self.app.Session.remove()
+
+        from database_setup import Item
+        session = self.app.Session()
+        owners = session.query(Item.user_id)\
+            .filter(Item.name.like(self.prefix + '%')).all()
+        self.app.Session.remove()
+        if len(owners) != self.requests:
+            self.leaks.append('{} of {} items saved'.format(
+                len(owners), self.requests))
+        strangers = [o for o, in owners if o != self.user_id]
+        if strangers:
+            self.leaks.append('items saved as users {}'.format(
+                sorted(set(strangers))))
+
+
+def scaling(thread_counts, duration, requests, db_latency):
+    """Read throughput by thread count, then concurrent writers checked
+    for state leaking between requests
+
+    In-process SQLite keeps every thread on the CPU, where the GIL
+    allows one at a time; `db_latency` seconds added to each statement
+    stand in for the round trip to a server database, which threads
+    with their own sessions and pooled connections wait out together.
+    """
+
+    import app
+    from db import engine, replicas
+    from sqlalchemy import event
+
+    def round_trip(*args):
+        time.sleep(db_latency)
+
+    results = {'throughput_rps': {}, 'errors': 0,
+               'db_latency_ms': db_latency * 1000}
+    if db_latency:
+        for each in [engine] + list(replicas):
+            event.listen(each, 'before_cursor_execute', round_trip)
+    try:
+        for threads in thread_counts:
+            run = load(threads, duration, read_only=True)
+            results['throughput_rps'][threads] = run['throughput_rps']
+            results['errors'] += run['errors']
+    finally:
+        if db_latency:
+            for each in [engine] + list(replicas):
+                event.remove(each, 'before_cursor_execute', round_trip)
+    base = results['throughput_rps'][thread_counts[0]]
+    results['speedup'] = dict(
+        (threads, round(rps / base, 2))
+        for threads, rps in results['throughput_rps'].items())
+    results['scales'] = not db_latency or \
+        results['speedup'][max(thread_counts)] >= MIN_SPEEDUP
+
+    from database_setup import Category, User
+
+    session = app.Session()
+    users = [u for u, in session.query(User.id).order_by(User.id)
+             .limit(max(thread_counts))]
+    category = session.query(Category).order_by(Category.id).first()
+    session.expunge(category)
+    app.Session.remove()
+    tag = random.Random().randrange(10 ** 9)
+    drivers = [IsolationDriver(app, user_id, category, requests, tag)
+               for user_id in users]
+    for driver in drivers:
+        driver.start()
+    for driver in drivers:
+        driver.join()
+    results['isolation'] = {
+        'threads': len(drivers),
+        'requests': 2 * requests * len(drivers),
+        'leaks': [leak for d in drivers for leak in d.leaks],
+    }
+    results['errors'] += sum(d.errors for d in drivers)
+    return results
+
+
+def concurrency_paths(max_item_id, count, rng):
+    """Return `count` GET paths spread over the read routes"""
+
+    paths = []
+    for n in range(count):
+        paths.append(rng.choice([
+            '/',
+            '/catalog/item/{}/'.format(rng.randint(1, max_item_id)),
+            '/api/v1/catalog.json',
+            '/api/v1/categories/JSON',
+        ]))
+    return paths
+
+
+def serve_sync(wsgi_app, clients, threads, paths, client_delay):
+    """Thread-per-connection server: a slow client holds its thread"""
+
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.test import EnvironBuilder
+
+    def handle(path):
+        time.sleep(client_delay)  # request trickling in
+        started_response = []
+        body = wsgi_app(EnvironBuilder(path=path).get_environ(),
+                        lambda status, headers, exc_info=None:
+                        started_response.append(status))
+        try:
+            for chunk in body:
+                pass
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        time.sleep(client_delay)  # response trickling out
+        return started_response[0]
+
+    samples = []
+    statuses = []
+    pool = ThreadPoolExecutor(max_workers=threads)
+
+    def client(client_paths):
+        for path in client_paths:
+            started = time.perf_counter()
+            statuses.append(pool.submit(handle, path).result())
+            samples.append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=client, args=(paths[n::clients],))
+               for n in range(clients)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    pool.shutdown()
+    return samples, statuses
+
+
+def serve_async(wsgi_app, clients, threads, paths, client_delay):
+    """ASGI adapter: slow client I/O waits on the event loop"""
+
+    from asgi import WsgiToAsgi
+
+    asgi_app = WsgiToAsgi(wsgi_app, threads=threads)
+    samples = []
+    statuses = []
+
+    async def request(path):
+        async def receive():
+            await asyncio.sleep(client_delay)
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+            elif not message.get('more_body'):
+                await asyncio.sleep(client_delay)
+
+        path, _, query = path.partition('?')
+        await asgi_app({
+            'type': 'http', 'method': 'GET', 'path': path,
+            'query_string': query.encode(), 'headers': [],
+            'server': ('localhost', 80), 'client': ('127.0.0.1', 0),
+        }, receive, send)
+
+    async def client(client_paths):
+        for path in client_paths:
+            started = time.perf_counter()
+            await request(path)
+            samples.append(time.perf_counter() - started)
+
+    async def main():
+        await asyncio.gather(*[client(paths[n::clients])
+                               for n in range(clients)])
+
+    asyncio.run(main())
+    asgi_app.executor.shutdown()
+    return samples, statuses
+
+
+def concurrency(clients, threads, requests, client_delay):
+    """Serve the same slow clients in sync and in async (ASGI) mode"""
+
+    import app
+    from database_setup import Item
+
+    app.create_app().secret_key = 'benchmark'
+    session = app.Session()
+    max_item_id = session.query(Item.id).order_by(Item.id.desc()).first()[0]
+    app.Session.remove()
+    paths = concurrency_paths(max_item_id, requests, random.Random(SEED))
+
+    results = {
+        'clients': clients,
+        'threads': threads,
+        'client_delay_ms': client_delay * 1000,
+    }
+    for mode, serve in (('sync', serve_sync), ('async', serve_async)):
+        app.cache.clear()
+        started = time.time()
+        samples, statuses = serve(
+            app.app.wsgi_app, clients, threads, paths, client_delay)
+        elapsed = time.time() - started
+        results[mode] = {
+            'duration_s': round(elapsed, 3),
+            'requests': len(samples),
+            'throughput_rps': round(len(samples) / elapsed, 1),
+            'errors': sum(1 for s in statuses if int(str(s)[:3]) >= 500),
+            'latency': percentiles(samples),
+        }
+    return results
+
+
+# Run in a fresh interpreter per sample; prints its timings as JSON.
+STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+flask_app.secret_key = 'benchmark'
+created = time.perf_counter()
+status = flask_app.test_client().get('/').status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'create_app': created - imported,
+    'first_request': served - created,
+    'status': status,
+    'oauth_loaded': 'oauth2client' in sys.modules,
+}))
+'''
+
+
+def startup(repeat):
+    """Time importing the app, configuring it and serving a first request"""
+
+    samples = {'process': [], 'import': [], 'create_app': [],
+               'first_request': []}
+    errors = 0
+    oauth_loaded = False
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT], stderr=subprocess.DEVNULL)
+        samples['process'].append(time.perf_counter() - started)
+        timings = json.loads(output.decode().strip().splitlines()[-1])
+        for name in ('import', 'create_app', 'first_request'):
+            samples[name].append(timings[name])
+        errors += timings['status'] >= 500
+        oauth_loaded = oauth_loaded or timings['oauth_loaded']
+    results = dict((name, percentiles(values))
+                   for name, values in samples.items())
+    results['errors'] = errors
+    results['oauth_loaded'] = oauth_loaded
+    return results
+
+
+def serialize(repeat):
+    """Query, serialize and encode every item: ORM objects through
+    jsonify versus column tuples through the fast encoder"""
+
+    import app
+    import fastjson
+    import tracemalloc
+    from database_setup import Item
+    from flask import jsonify
+    from queries import ITEM_COLUMNS, serialize_rows
+
+    def orm_jsonify(session):
+        items = session.query(Item).order_by(Item.id).all()
+        return jsonify(catalog=[i.serialize for i in items]).get_data()
+
+    def columns_jsonify(session):
+        rows = session.query(*ITEM_COLUMNS).order_by(Item.id).all()
+        return jsonify(catalog=serialize_rows(rows)).get_data()
+
+    def columns_fastjson(session):
+        rows = session.query(*ITEM_COLUMNS).order_by(Item.id).all()
+        return fastjson.jsonify(catalog=serialize_rows(rows)).get_data()
+
+    variants = [('orm_jsonify', orm_jsonify),
+                ('columns_jsonify', columns_jsonify),
+                ('columns_fastjson', columns_fastjson)]
+
+    flask_app = app.create_app()
+    results = {'encoder': fastjson.ENCODER}
+    outputs = set()
+    with flask_app.test_request_context('/'):
+        session = app.Session()
+        rows = session.query(Item).count()
+        app.Session.remove()
+        results['rows'] = rows
+        for name, fn in variants:
+            samples = []
+            for _ in range(repeat):
+                # A fresh session each time, so no identity map is reused.
+                session = app.Session.session_factory()
+                started = time.perf_counter()
+                outputs.add(fn(session))
+                samples.append(time.perf_counter() - started)
+                session.close()
+
+            session = app.Session.session_factory()
+            tracemalloc.start()
+            fn(session)
+            allocated, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            session.close()
+
+            stats = percentiles(samples)
+            stats['us_per_row'] = round(
+                stats['p50_ms'] * 1000 / max(rows, 1), 3)
+            stats['peak_bytes_per_row'] = round(peak / max(rows, 1), 1)
+            results[name] = stats
+    results['identical_output'] = len(outputs) == 1
+    return results
+
+
+def queries():
+    """Count the SQL statements of the hot pages, cold and cached"""
+
+    import app
+    from database_setup import Item
+    from db import engine, replicas
+    from sqlalchemy import event
+
+    app.create_app().secret_key = 'benchmark'
+    session = app.Session()
+    item = session.query(Item).order_by(Item.id).first()
+    app.Session.remove()
+    paths = {
+        'home': '/',
+        'show_items_in_category': '/catalog/category/{}/items/'.format(
+            item.category_id),
+        'view_item': '/catalog/item/{}/'.format(item.id),
+        'catalog_item_json': '/api/v1/categories/{}/item/{}/JSON'.format(
+            item.category_id, item.id),
+    }
+
+    # Only this thread's: the app's background threads query too.
+    counted = []
+    thread = threading.get_ident()
+
+    def count(*args):
+        if threading.get_ident() == thread:
+            counted.append(args[2])
+
+    for each in [engine] + list(replicas):
+        event.listen(each, 'before_cursor_execute', count)
+    client = app.app.test_client()
+    results = {'errors': 0, 'over_budget': []}
+    try:
+        for endpoint, path in sorted(paths.items()):
+            app.cache.clear()
+            app.user_cache.clear()
+            del counted[:]
+            status = client.get(path).status_code
+            cold = list(counted)
+            del counted[:]
+            client.get(path)
+            results['errors'] += status >= 500
+            results[endpoint] = {
+                'status': status,
+                'cold': len(cold),
+                'cached': len(counted),
+                'budget': QUERY_BUDGETS[endpoint],
+                'statements': cold,
+            }
+            if len(cold) > QUERY_BUDGETS[endpoint]:
+                results['over_budget'].append(endpoint)
+    finally:
+        for each in [engine] + list(replicas):
+            event.remove(each, 'before_cursor_execute', count)
+    return results
+
+
+def search(repeat):
+    """Time search_items() on the seeded catalog against the p99 target"""
+
+    import app
+    from search import CANDIDATES, search_items
+
+    app.create_app()
+    results = {'candidates': CANDIDATES,
+               'target_p99_ms': SEARCH_P99_TARGET_MS, 'searches': {}}
+    everything = []
+    for terms, category_id in SEARCHES:
+        def run():
+            search_items(terms, category_id)
+            app.Session.remove()
+
+        run()
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            samples.append(time.perf_counter() - started)
+        everything.extend(samples)
+        name = terms if category_id is None else '{} in category {}'.format(
+            terms, category_id)
+        results['searches'][name] = percentiles(samples)
+    results['overall'] = percentiles(everything)
+    results['slow'] = sorted(
+        name for name, stats in results['searches'].items()
+        if stats['p99_ms'] >= SEARCH_P99_TARGET_MS)
+    return results
+
+
+def failed_requests(results):
+    """Count the 5xx responses a run recorded"""
+
+    errors = results.get('errors', 0)
+    for mode in ('sync', 'async'):
+        errors += results.get(mode, {}).get('errors', 0)
+    return errors
+
+
+def save(kind, scale, results, output=None):
+    """Write results as JSON and return the path"""
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, '{}-{}-{}-{}.json'.format(
+            kind, scale, commit or 'nocommit', stamp))
+    with io.open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'kind': kind,
+            'scale': scale,
+            'commit': commit,
+            'timestamp': stamp,
+            'python': sys.version.split()[0],
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+    return output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', choices=[
+        'seed', 'micro', 'load', 'concurrency', 'startup', 'serialize',
+        'queries', 'scaling', 'search'])
+    parser.add_argument('--scale', type=int, default=10000,
+                        help='number of items in the dataset')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--thread-counts', default='1,2,4,8',
+                        help='thread counts of the scaling run')
+    parser.add_argument('--db-latency', type=float, default=2.0,
+                        help='milliseconds added to every statement of '
+                             'the scaling run')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--read-only', action='store_true')
+    parser.add_argument('--clients', type=int, default=100,
+                        help='concurrent clients for the concurrency run')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--client-delay', type=float, default=0.05,
+                        help='seconds each client takes to send and to read')
+    parser.add_argument('--output', help='results file (default: generated)')
+    args = parser.parse_args(argv)
+
+    use_database(database_path(args.scale))
+    seed(args.scale)
+    if args.command == 'seed':
+        return
+    if args.command == 'scaling' or (
+            args.command == 'load' and not args.read_only):
+        # Writes go to a throwaway copy so every run starts from the
+        # same seeded data.
+        run_path = database_path(args.scale) + '.run'
+        shutil.copyfile(database_path(args.scale), run_path)
+        use_database(run_path)
+
+    if args.command == 'micro':
+        results = micro(args.repeat)
+    elif args.command == 'serialize':
+        results = serialize(args.repeat)
+    elif args.command == 'startup':
+        results = startup(args.repeat)
+    elif args.command == 'scaling':
+        results = scaling(
+            [int(n) for n in args.thread_counts.split(',')], args.duration,
+            args.requests // 10, args.db_latency / 1000)
+    elif args.command == 'queries':
+        results = queries()
+    elif args.command == 'search':
+        results = search(args.repeat)
+    elif args.command == 'concurrency':
+        results = concurrency(args.clients, args.threads, args.requests,
+                              args.client_delay)
+    else:
+        results = load(args.threads, args.duration, args.read_only)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    errors = failed_requests(results)
+    if errors:
+        # Timings of failing requests would make a broken commit look fast.
+        sys.exit('{} requests failed with a 5xx; results not saved'.format(
+            errors))
+    if results.get('scales') is False:
+        sys.exit('Throughput does not scale with threads: {}'.format(
+            results['throughput_rps']))
+    if results.get('isolation', {}).get('leaks'):
+        sys.exit('State leaked between requests: {}'.format(
+            '; '.join(results['isolation']['leaks'])))
+    if results.get('over_budget'):
+        sys.exit('More SQL statements than budgeted: {}'.format(
+            ', '.join(results['over_budget'])))
+    print('Saved to ' + save(args.command, args.scale, results, args.output),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+"""Response and HTTP caching for the read endpoints.
+
+Entries are tagged with the data they were built from (``items``,
+``categories``, ``item:<id>``, ``category:<id>``) and the write views
+invalidate exactly the tags they touch. Conditional GETs are answered
+from the catalog version counter without running the view at all, and
+login-independent page fragments are shared between users per version.
+"""
+
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, render_template, request
+from flask import session as login_session
+from markupsafe import Markup
+from queries import get_catalog_version
+
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LRUCache(object):
+    """Bounded in-process cache with per-entry expiry"""
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, tags=(), ttl=None):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            expires = time.time() + (self.ttl if ttl is None else ttl)
+            self.entries[key] = (expires, value, tuple(tags))
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self._drop(key)
+
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                for key in self.tags.pop(tag, ()):
+                    self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def stats(self):
+        return {
+            'backend': 'lru',
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+
+class RedisCache(object):
+    """Cache shared by every worker through Redis"""
+
+    def __init__(self, client, ttl=300, prefix='catalog:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value, tags=(), ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        pipe = self.client.pipeline()
+        pipe.setex(self.prefix + key, ttl, pickle.dumps(value))
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            pipe.sadd(tag_key, self.prefix + key)
+            pipe.expire(tag_key, ttl)
+        pipe.execute()
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = self.client.smembers(tag_key)
+            self.client.delete(tag_key, *keys)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'hits': self.hits,
+            'misses': self.misses,
+            # Redis evicts on its own; report the server-wide count.
+            'evictions': self.client.info('stats').get('evicted_keys', 0)
+        }
+
+
+def make_cache(url=None):
+    """Build the cache backend named by `url` (redis://... or None)"""
+
+    ttl = int(os.environ.get('CATALOG_CACHE_TTL', 300))
+    if url:
+        if redis is None:
+            raise RuntimeError('The redis package is needed for ' + url)
+        return RedisCache(redis.Redis.from_url(url), ttl=ttl)
+    return LRUCache(
+        max_entries=int(os.environ.get('CATALOG_CACHE_SIZE', 1024)),
+        ttl=ttl)
+
+
+cache = make_cache(os.environ.get('CATALOG_CACHE_URL'))
+
+
+def add_cache_tags(*tags):
+    """Tag the response being cached with data found inside the view"""
+
+    g.setdefault('cache_tags', set()).update(tags)
+
+
+def cached(*tags):
+    """Cache a GET view's response, varying on path, query, login and
+    catalog version
+
+    A tag may be a format string filled in from the view arguments,
+    e.g. ``'item:{item_id}'``.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            # Pending flash messages are consumed by the render.
+            if request.method != 'GET' or '_flashes' in login_session:
+                return view(**kwargs)
+
+            # Keyed on the catalog version the view reads, so a lagging
+            # read replica cannot refill the cache with stale pages.
+            key = 'view:{}:{}:{}:{}'.format(
+                page_version(),
+                login_session.get('user_id', 'anon'),
+                request.path,
+                request.query_string.decode())
+            hit = cache.get(key)
+            if hit is not None:
+                body, mimetype = hit
+                return current_app.response_class(body, mimetype=mimetype)
+
+            response = current_app.make_response(view(**kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                entry_tags = {tag.format(**kwargs) for tag in tags}
+                entry_tags.update(g.pop('cache_tags', ()))
+                cache.set(
+                    key, (response.get_data(), response.mimetype), entry_tags)
+            return response
+        return wrapper
+    return decorator
+
+
+def conditional(view):
+    """Answer If-None-Match / If-Modified-Since from the catalog version"""
+
+    @wraps(view)
+    def wrapper(**kwargs):
+        if request.method != 'GET' or '_flashes' in login_session:
+            return view(**kwargs)
+
+        updated_at = catalog_version()[1]
+        etag = hashlib.sha1('{}:{}:{}'.format(
+            page_version(),
+            login_session.get('user_id', 'anon'),
+            request.full_path).encode()).hexdigest()
+        last_modified = updated_at and updated_at.replace(microsecond=0)
+        if request.endpoint in page_versions:
+            # The page also shows data the catalog's update time does
+            # not cover; only the ETag can tell it has not changed.
+            last_modified = None
+
+        if request.if_none_match:
+            # Weak comparison: compressed responses carry a weak ETag.
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = (
+                last_modified is not None and
+                request.if_modified_since is not None and
+                last_modified <= request.if_modified_since.replace(
+                    tzinfo=None))
+
+        if not_modified:
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.make_response(view(**kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        if last_modified is not None:
+            # Werkzeug would turn None into the current time.
+            response.last_modified = last_modified
+        return response
+    return wrapper
+
+
+# Versions of other data some pages show, by endpoint: callables whose
+# value is part of those pages' cache keys and ETags.
+page_versions = {}
+
+
+def page_version():
+    """Return the version of everything the current page is built from"""
+
+    version = catalog_version()[0]
+    extra = page_versions.get(request.endpoint)
+    if extra is None:
+        return version
+    return '{}.{}'.format(version, extra())
+
+
+def catalog_version():
+    """Return the catalog version, read at most once per request"""
+
+    if 'catalog_version' not in g:
+        g.catalog_version = get_catalog_version()
+    return g.catalog_version
+
+
+def render_fragment(template, key, load):
+    """Render a login-independent fragment, shared per catalog version
+
+    `key` identifies the fragment's arguments and `load` returns its
+    template context; it is only called on a cache miss.
+    """
+
+    cache_key = 'fragment:{}:{}:{}'.format(
+        catalog_version()[0], template, key)
+    html = cache.get(cache_key)
+    if html is None:
+        html = render_template(template, **load())
+        cache.set(cache_key, html)
+    return Markup(html)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+"""Catalog change feed.
+
+Every item and category write appends a row to the catalog_change log,
+numbered by an increasing ``seq``. Clients ask for the changes after the
+last seq they saw: a page at a time from /api/v1/changes?since=<seq>, or
+live as Server-Sent Events from /api/v1/changes/stream (resumable with
+Last-Event-ID).
+
+One poller thread per process reads new log rows and keeps the recent
+ones in memory. Stream clients wait on it rather than on the database,
+so an idle stream holds no connection; under asgi.py it holds no thread
+either. Other servers (serve.py included) hold a request thread per
+stream, so they serve at most CATALOG_MAX_STREAMS of them per process.
+
+Bulk loads through import_catalog.py log one ``catalog``/``import`` row
+per transaction instead of a row per item; a client that sees one
+should resync.
+
+feed.close() ends every stream, e.g. before a worker exits; clients
+reconnect elsewhere and resume from Last-Event-ID.
+"""
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+from urllib.parse import parse_qs
+from database_setup import CatalogChange
+from db import engine
+
+import asyncio
+import collections
+import json
+import os
+import threading
+import time
+
+POLL_INTERVAL = float(os.environ.get('CATALOG_CHANGES_POLL_INTERVAL', 1))
+
+# Idle streams get a comment this often so proxies keep them open.
+HEARTBEAT_SECONDS = 15
+
+# Changes kept in memory for stream clients that are slightly behind.
+BUFFER_SIZE = 10000
+
+# Rows read from the log per query.
+PAGE_SIZE = 1000
+
+# Streams served from request threads, per process.
+MAX_STREAMS = int(os.environ.get('CATALOG_MAX_STREAMS', 32))
+
+table = CatalogChange.__table__
+
+
+def to_json(row):
+    return {
+        'seq': row.seq,
+        'type': row.kind,
+        'id': row.object_id,
+        'action': row.action,
+        'changed_at': row.changed_at.isoformat(),
+        'data': json.loads(row.data) if row.data is not None else None,
+    }
+
+
+def read_changes(connection, since, limit=PAGE_SIZE):
+    """Return up to `limit` changes after seq `since`, oldest first"""
+
+    rows = connection.execute(
+        table.select().where(table.c.seq > since)
+        .order_by(table.c.seq).limit(limit))
+    return [to_json(row) for row in rows]
+
+
+def latest_seq(connection):
+    return connection.execute(select([func.max(table.c.seq)])).scalar() or 0
+
+
+def log_batch(connection, rows):
+    """Append change log rows written outside the ORM"""
+
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+class ChangeFeed(object):
+    """Poll the change log from one thread and wake up waiting streams
+
+    Sequence numbers are assumed to become visible in order, which holds
+    for SQLite's single writer.
+    """
+
+    def __init__(self, engine, interval=POLL_INTERVAL,
+                 buffer_size=BUFFER_SIZE):
+        self.engine = engine
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.recent = collections.deque()
+        # Every change after `floor` is in `recent`.
+        self.floor = None
+        self.last_seq = None
+        self.condition = threading.Condition()
+        self.waiters = set()
+        self.thread = None
+        self.closed = False
+        # Streams holding a request thread.
+        self.streams = 0
+
+    def start(self):
+        """Start polling, once per process"""
+
+        with self.condition:
+            if self.thread is not None:
+                return
+            with self.engine.connect() as connection:
+                self.last_seq = self.floor = latest_seq(connection)
+            self.thread = threading.Thread(
+                target=self.run, name='change-feed', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                with self.engine.connect() as connection:
+                    changes = read_changes(connection, self.last_seq)
+            except SQLAlchemyError:
+                changes = []
+            if changes:
+                self.publish(changes)
+            if len(changes) < PAGE_SIZE:
+                time.sleep(self.interval)
+
+    def publish(self, changes):
+        with self.condition:
+            self.recent.extend(changes)
+            while len(self.recent) > self.buffer_size:
+                self.floor = self.recent.popleft()['seq']
+            self.last_seq = changes[-1]['seq']
+        self.wake()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+            waiters = list(self.waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def close(self):
+        """End every stream, e.g. when the server shuts down"""
+
+        self.closed = True
+        self.wake()
+
+    def full(self):
+        return self.streams >= MAX_STREAMS
+
+    def since(self, seq):
+        """Return buffered changes after `seq`, or None if the buffer no
+        longer reaches back that far"""
+
+        with self.condition:
+            if seq >= self.last_seq:
+                return []
+            if seq < self.floor:
+                return None
+            changes = []
+            for change in reversed(self.recent):
+                if change['seq'] <= seq:
+                    break
+                changes.append(change)
+            changes.reverse()
+            return changes
+
+    def wait(self, seq, timeout):
+        """Block until there are changes after `seq`; False on timeout"""
+
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.last_seq > seq or self.closed, timeout)
+
+    async def wait_async(self, seq, timeout):
+        """Like wait(), without holding a thread"""
+
+        waiter = (asyncio.get_event_loop(), asyncio.Event())
+        with self.condition:
+            if self.last_seq > seq or self.closed:
+                return True
+            self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.condition:
+                self.waiters.discard(waiter)
+
+
+def event(changes):
+    """Format changes as Server-Sent Events"""
+
+    return ''.join(
+        'id: {}\nevent: change\ndata: {}\n\n'.format(
+            change['seq'], json.dumps(change))
+        for change in changes)
+
+
+HEARTBEAT = ': keep-alive\n\n'
+RETRY = 'retry: 3000\n\n'
+
+
+def stream(feed, since=None):
+    """Yield Server-Sent Events for changes after `since` until the
+    feed is closed"""
+
+    feed.start()
+    if since is None:
+        since = feed.last_seq
+    with feed.condition:
+        feed.streams += 1
+    try:
+        yield RETRY
+        while not feed.closed:
+            changes = feed.since(since)
+            if changes is None:
+                with feed.engine.connect() as connection:
+                    changes = read_changes(connection, since)
+            if not changes:
+                if not feed.wait(since, HEARTBEAT_SECONDS):
+                    yield HEARTBEAT
+                continue
+            yield event(changes)
+            since = changes[-1]['seq']
+    finally:
+        with feed.condition:
+            feed.streams -= 1
+
+
+def make_asgi_stream(feed):
+    """Return an ASGI app serving stream() on the event loop"""
+
+    def read_log(since):
+        with feed.engine.connect() as connection:
+            return read_changes(connection, since)
+
+    async def wait_for_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def send_text(send, text):
+        await send({'type': 'http.response.body',
+                    'body': text.encode('utf-8'), 'more_body': True})
+
+    async def asgi_stream(scope, receive, send):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, feed.start)
+        since = start_seq(scope)
+        if since is None:
+            since = feed.last_seq
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'),
+                        (b'cache-control', b'no-cache')],
+        })
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send_text(send, RETRY)
+            while not disconnected.done() and not feed.closed:
+                changes = feed.since(since)
+                if changes is None:
+                    changes = await loop.run_in_executor(
+                        None, read_log, since)
+                if not changes:
+                    waiting = asyncio.ensure_future(
+                        feed.wait_async(since, HEARTBEAT_SECONDS))
+                    await asyncio.wait(
+                        [waiting, disconnected],
+                        return_when=asyncio.FIRST_COMPLETED)
+                    if not waiting.done():
+                        waiting.cancel()
+                    elif not waiting.result():
+                        await send_text(send, HEARTBEAT)
+                    continue
+                await send_text(send, event(changes))
+                since = changes[-1]['seq']
+            if not disconnected.done():
+                # Closed by the server: end the response cleanly.
+                await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            pass
+        finally:
+            disconnected.cancel()
+
+    return asgi_stream
+
+
+def start_seq(scope):
+    """Read `since` from the query string, else Last-Event-ID"""
+
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    value = query.get('since', [None])[0]
+    if value is None:
+        value = dict(scope.get('headers', ())).get(
+            b'last-event-id', b'').decode('latin-1') or None
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+feed = ChangeFeed(engine)
+asgi_stream = make_asgi_stream(feed)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""Compress dynamic responses for clients that accept it.
+
+HTML and JSON bodies of at least CATALOG_COMPRESS_MIN_SIZE bytes are sent
+brotli (with the brotli package) or gzip encoded, as the request's
+Accept-Encoding allows. Streamed responses and files are left alone.
+"""
+
+from flask import request
+
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIN_SIZE = int(os.environ.get('CATALOG_COMPRESS_MIN_SIZE', 1024))
+
+COMPRESSIBLE = ('text/html', 'application/json', 'text/plain', 'text/css',
+                'application/javascript', 'application/x-ndjson')
+
+# Fast settings: this runs on every response, cached or not.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def compress_response(response):
+    """after_request hook: encode the body if it is worth it"""
+
+    if response.direct_passthrough or response.is_streamed or \
+            response.status_code != 200 or \
+            'Content-Encoding' in response.headers or \
+            response.mimetype not in COMPRESSIBLE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding = 'br'
+    elif accepted['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+
+    data = response.get_data()
+    if len(data) < MIN_SIZE:
+        return response
+    if encoding == 'br':
+        data = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+
+    # The encoded body is a different representation of the same page.
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
-from sqlalchemy import create_engine
+from collections import Counter
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Text
+from sqlalchemy import bindparam
 from sqlalchemy.orm import relationship
 
+import datetime
+import json
+
 Base = declarative_base()
 
 
@@ -14,8 +19,9 @@ class User(Base):
     __tablename__ = "user"
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, unique=True, index=True)
     picture = Column(String(250))
+    item_count = Column(Integer, nullable=False, default=0, server_default='0')
 
 
 class Category(Base):
@@ -23,9 +29,10 @@ class Category(Base):
 
     __tablename__ = "category"
     id = Column(Integer, primary_key=True)
-    name = Column(String(50), nullable=False)
-    user_id = Column(Integer, ForeignKey('user.id'))
+    name = Column(String(50), nullable=False, unique=True, index=True)
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     user = relationship(User)
+    item_count = Column(Integer, nullable=False, default=0, server_default='0')
 
     @property
     def serialize(self):
@@ -43,12 +50,17 @@ class Item(Base):
 
     __tablename__ = "item"
     id = Column(Integer, primary_key=True)
-    name = Column(String(80), nullable=False)
+    name = Column(String(80), nullable=False, index=True)
     description = Column(String(250))
-    category_id = Column(Integer, ForeignKey('category.id'))
+    category_id = Column(Integer, ForeignKey('category.id'), index=True)
     category = relationship(Category)
-    user_id = Column(Integer, ForeignKey('user.id'))
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     user = relationship(User)
+    updated_at = Column(
+        DateTime,
+        index=True,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
 
     @property
     def serialize(self):
@@ -63,5 +75,176 @@ class Item(Base):
         }
 
 
-engine = create_engine('sqlite:///catalog.db')
-Base.metadata.create_all(engine)
+class CatalogVersion(Base):
+    """Single-row counter bumped by every item or category write"""
+
+    __tablename__ = "catalog_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class CatalogStats(Base):
+    """Single-row catalog totals, kept up to date by every write"""
+
+    __tablename__ = "catalog_stats"
+    id = Column(Integer, primary_key=True)
+    items = Column(Integer, nullable=False, default=0)
+    categories = Column(Integer, nullable=False, default=0)
+    users = Column(Integer, nullable=False, default=0)
+
+
+class CatalogChange(Base):
+    """Append-only log of item and category writes, numbered by `seq`"""
+
+    __tablename__ = "catalog_change"
+    # Never reuse a seq, even after the newest row is gone.
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = Column(Integer, primary_key=True)
+    kind = Column(String(16), nullable=False)
+    object_id = Column(Integer, nullable=False)
+    action = Column(String(16), nullable=False)
+    data = Column(Text)
+    changed_at = Column(DateTime, nullable=False)
+
+
+class ItemViews(Base):
+    """How many times each item's page was viewed, flushed in batches"""
+
+    __tablename__ = "item_view"
+    # No foreign key: rows of deleted items are pruned by the ranking.
+    item_id = Column(Integer, primary_key=True, autoincrement=False)
+    views = Column(Integer, nullable=False, default=0)
+
+
+class WebSession(Base):
+    """Server-side login session data, keyed by the cookie's opaque id"""
+
+    __tablename__ = "web_session"
+    id = Column(String(64), primary_key=True)
+    data = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+def bump_catalog_version(connection):
+    """Bump the catalog version inside the transaction that changes it"""
+
+    table = CatalogVersion.__table__
+    now = datetime.datetime.utcnow()
+    result = connection.execute(
+        table.update().values(version=table.c.version + 1, updated_at=now))
+    if result.rowcount == 0:
+        connection.execute(
+            table.insert().values(id=1, version=1, updated_at=now))
+
+
+def bump_on_catalog_flush(session, flush_context):
+    """Bump the catalog version when a flush writes items or categories"""
+
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(isinstance(obj, (Category, Item)) for obj in changed):
+        bump_catalog_version(session)
+
+
+def apply_count_deltas(connection, categories, users, totals):
+    """Add Counter deltas to item counts and catalog totals"""
+
+    for table, deltas in ((Category.__table__, categories),
+                          (User.__table__, users)):
+        changes = [{'row_id': key, 'delta': delta}
+                   for key, delta in deltas.items()
+                   if key is not None and delta]
+        if changes:
+            connection.execute(
+                table.update()
+                .where(table.c.id == bindparam('row_id'))
+                .values(item_count=table.c.item_count + bindparam('delta')),
+                changes)
+
+    if any(totals.values()):
+        table = CatalogStats.__table__
+        # c['items'], since c.items is the collection's own method.
+        result = connection.execute(table.update().values(
+            items=table.c['items'] + totals['items'],
+            categories=table.c['categories'] + totals['categories'],
+            users=table.c['users'] + totals['users']))
+        if result.rowcount == 0:
+            recompute_counts(connection)
+
+
+def count_on_flush(session, flush_context):
+    """Keep item counts and catalog totals in step with ORM writes"""
+
+    categories, users, totals = Counter(), Counter(), Counter()
+    for objects, sign in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            if isinstance(obj, Item):
+                categories[obj.category_id] += sign
+                users[obj.user_id] += sign
+                totals['items'] += sign
+            elif isinstance(obj, Category):
+                totals['categories'] += sign
+            elif isinstance(obj, User):
+                totals['users'] += sign
+
+    # Items moved to another category or owner.
+    for obj in session.dirty:
+        if not isinstance(obj, Item):
+            continue
+        attrs = inspect(obj).attrs
+        for name, deltas in (('category_id', categories),
+                             ('user_id', users)):
+            history = attrs[name].history
+            if history.added or history.deleted:
+                for old in history.deleted:
+                    deltas[old] -= 1
+                for new in history.added:
+                    deltas[int(new) if new is not None else None] += 1
+
+    apply_count_deltas(session, categories, users, totals)
+
+
+def change_row(kind, object_id, action, data, now):
+    """Return a catalog_change row; `data` is the serialized object"""
+
+    return {
+        'kind': kind,
+        'object_id': object_id,
+        'action': action,
+        'data': json.dumps(data) if data is not None else None,
+        'changed_at': now,
+    }
+
+
+def log_on_flush(session, flush_context):
+    """Append a change log row for every item and category write"""
+
+    now = datetime.datetime.utcnow()
+    rows = []
+    for objects, action in ((session.new, 'create'),
+                            (session.dirty, 'update'),
+                            (session.deleted, 'delete')):
+        for obj in objects:
+            if not isinstance(obj, (Category, Item)):
+                continue
+            if action == 'update' and not session.is_modified(
+                    obj, include_collections=False):
+                continue
+            kind = 'item' if isinstance(obj, Item) else 'category'
+            data = obj.serialize if action != 'delete' else None
+            rows.append(change_row(kind, obj.id, action, data, now))
+    if rows:
+        session.execute(CatalogChange.__table__.insert(), rows)
+
+
+from db import Session, engine  # noqa: E402
+from migrations import recompute_counts, upgrade  # noqa: E402
+event.listen(Session, 'after_flush', bump_on_catalog_flush)
+event.listen(Session, 'after_flush', count_on_flush)
+event.listen(Session, 'after_flush', log_on_flush)
+
+
+if __name__ == '__main__':
+    # Creating or upgrading the schema is an explicit step, never a side
+    # effect of importing the models.
+    upgrade(engine, Base.metadata)
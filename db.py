@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import sqlite3
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session as BaseSession
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+
+# Point this at a pooled server database (e.g. postgresql://...) in
+# production; the SQLite file is only meant for local development.
+DATABASE_URL = os.environ.get('CATALOG_DATABASE_URL', 'sqlite:///catalog.db')
+
+POOL_SIZE = int(os.environ.get('CATALOG_DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('CATALOG_DB_MAX_OVERFLOW', 10))
+POOL_RECYCLE = int(os.environ.get('CATALOG_DB_POOL_RECYCLE', 1800))
+POOL_PRE_PING = os.environ.get('CATALOG_DB_POOL_PRE_PING', '1') == '1'
+
+# Comma separated read replicas of DATABASE_URL. GET requests read from
+# one of them; writes, and a user's reads for REPLICA_STICKY_SECONDS after
+# they commit, go to the primary.
+REPLICA_URLS = [url for url in os.environ.get(
+    'CATALOG_REPLICA_URLS', '').split(',') if url]
+REPLICA_STICKY_SECONDS = float(
+    os.environ.get('CATALOG_REPLICA_STICKY_SECONDS', 5))
+
+# Set on every new SQLite file connection. WAL lets readers run alongside
+# the single writer, and the busy timeout makes a writer wait for the lock
+# instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('CATALOG_SQLITE_BUSY_TIMEOUT', 5000)),
+    'mmap_size': int(os.environ.get('CATALOG_SQLITE_MMAP_SIZE', 268435456)),
+    'cache_size': int(os.environ.get('CATALOG_SQLITE_CACHE_SIZE', -65536)),
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+
+def make_engine(url=DATABASE_URL):
+    """Create an engine with a tunable connection pool"""
+
+    if url in ('sqlite://', 'sqlite:///:memory:'):
+        # Every pooled connection would get its own empty database.
+        return create_engine(
+            url,
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool
+        )
+
+    options = {
+        'pool_size': POOL_SIZE,
+        'max_overflow': MAX_OVERFLOW,
+        'pool_recycle': POOL_RECYCLE,
+        'pool_pre_ping': POOL_PRE_PING
+    }
+
+    if url.startswith('sqlite'):
+        # Connections are handed between request threads by the pool,
+        # never shared by two threads at once.
+        options['connect_args'] = {'check_same_thread': False}
+        options['poolclass'] = QueuePool
+        engine = create_engine(url, **options)
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        return engine
+
+    return create_engine(url, **options)
+
+
+engine = make_engine()
+replicas = [make_engine(url) for url in REPLICA_URLS]
+
+
+def pick_replica():
+    """Return a replica engine to read from, or None without replicas"""
+
+    return random.choice(replicas) if replicas else None
+
+
+class RoutingSession(BaseSession):
+    """Session that reads from the replica in info['replica'], if set
+
+    Flushes, and every session without a replica, use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is None or self._flushing:
+            return engine
+        return replica
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def note_commit(session):
+    session.info['committed'] = True
+
+
+# One session per request thread, removed again in the app teardown hook.
+Session = scoped_session(sessionmaker(bind=engine, class_=RoutingSession))
+
+
+def sync_replicas():
+    """Copy a SQLite primary onto SQLite replica files, for local testing"""
+
+    source = sqlite3.connect(make_url(DATABASE_URL).database)
+    for url in REPLICA_URLS:
+        target = sqlite3.connect(make_url(url).database)
+        source.backup(target)
+        target.close()
+    source.close()
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] != ['sync-replicas']:
+        sys.exit('usage: python db.py sync-replicas')
+    sync_replicas()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""JSON responses for the API, through orjson when it is installed.
+
+The bytes are the same as Flask's jsonify: sorted keys, compact
+separators, non-ASCII characters escaped and a trailing newline.
+CATALOG_JSON_ENCODER=json forces the standard library; pretty-printed
+(debug) responses always use it.
+
+orjson formats some floats differently (1e-6 rather than 1e-06), so
+only use this for payloads without floats, like the catalog API's.
+"""
+
+from flask import current_app, json as flask_json, jsonify as flask_jsonify
+
+import os
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODER = os.environ.get(
+    'CATALOG_JSON_ENCODER', 'orjson' if orjson is not None else 'json')
+
+# json.dumps(ensure_ascii=True) also escapes DEL.
+NON_ASCII = re.compile('[^\x00-\x7e]')
+
+
+def escape_non_ascii(match):
+    """Escape one character the way json.dumps(ensure_ascii=True) does"""
+
+    code = ord(match.group())
+    if code > 0xffff:
+        code -= 0x10000
+        return '\\u{:04x}\\u{:04x}'.format(
+            0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+    return '\\u{:04x}'.format(code)
+
+
+def default(obj):
+    """Encode what orjson leaves to us (dates, Markup) as Flask would"""
+
+    return flask_json.JSONEncoder().default(obj)
+
+
+def dumps(obj, sort_keys=True, ensure_ascii=True):
+    """Return compact JSON bytes with a trailing newline"""
+
+    option = orjson.OPT_APPEND_NEWLINE | orjson.OPT_PASSTHROUGH_DATETIME
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    data = orjson.dumps(obj, default=default, option=option)
+    if ensure_ascii and (not data.isascii() or b'\x7f' in data):
+        data = NON_ASCII.sub(
+            escape_non_ascii, data.decode('utf-8')).encode('ascii')
+    return data
+
+
+def jsonify(*args, **kwargs):
+    """Drop-in for flask.jsonify that encodes with orjson when it can"""
+
+    config = current_app.config
+    if ENCODER != 'orjson' or config['JSONIFY_PRETTYPRINT_REGULAR'] or \
+            current_app.debug:
+        return flask_jsonify(*args, **kwargs)
+
+    data = args[0] if len(args) == 1 else (args or kwargs)
+    try:
+        body = dumps(data, config['JSON_SORT_KEYS'], config['JSON_AS_ASCII'])
+    except TypeError:
+        # e.g. integers wider than 64 bits
+        return flask_jsonify(*args, **kwargs)
+    return current_app.response_class(
+        body, mimetype=config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+"""Bulk loader for large catalog feeds.
+
+    python import_catalog.py load items.ndjson --owner-email me@example.com
+    python import_catalog.py load items.csv --batch-size 20000
+    python import_catalog.py generate 1000000 > items.ndjson
+
+Input rows (CSV columns or NDJSON keys) are ``name``, ``description``,
+``category`` and optionally ``user_email``/``user_name``; rows without a
+user are owned by ``--owner-email``. Categories and users are resolved
+through in-memory name-to-id maps and created on first sight. Items are
+written with executemany in large transactions, and the number of input
+rows consumed is checkpointed in the same transaction, so re-running a
+failed load resumes where it stopped.
+
+``--defer-search-index`` drops the full-text triggers for the duration
+of the load and rebuilds the index once at the end, which is several
+times faster for large loads. If such a load is killed outright, run
+``python search.py rebuild`` to restore them.
+"""
+
+from collections import Counter
+from database_setup import Base, Category, Item, User
+from database_setup import apply_count_deltas, bump_catalog_version
+from database_setup import change_row
+from changes import log_batch
+from db import engine
+from migrations import add_item_search_index, upgrade
+from sqlalchemy import text
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import time
+
+BATCH_SIZE = 10000
+BATCHES_PER_TRANSACTION = 10
+
+# Applied to the loading connection only; durability is traded for
+# speed because a crashed load is resumed from the last checkpoint.
+LOAD_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'OFF',
+    'temp_store': 'MEMORY',
+    'cache_size': '-262144',
+}
+
+
+SEARCH_TRIGGERS = ['item_fts_insert', 'item_fts_update', 'item_fts_delete']
+
+
+# Fields read from an input row.
+FIELDS = ('name', 'description', 'category', 'user_email', 'user_name')
+
+
+class RowError(ValueError):
+    """An input row that cannot be imported"""
+
+
+def read_rows(path, input_format):
+    """Yield input rows as dicts, streaming the file"""
+
+    stream = sys.stdin if path == '-' else io.open(path, encoding='utf-8')
+    try:
+        if input_format == 'csv':
+            for row in csv.DictReader(stream):
+                yield row
+        else:
+            for line in stream:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield {'_error': 'invalid JSON'}
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def validate(row):
+    """Return the cleaned row or raise RowError"""
+
+    if not isinstance(row, dict):
+        raise RowError('row is not an object')
+    if '_error' in row:
+        raise RowError(row['_error'])
+    for field in FIELDS:
+        if row.get(field) is not None and not isinstance(row[field], str):
+            raise RowError(field + ' is not a string')
+
+    name = (row.get('name') or '').strip()
+    category = (row.get('category') or '').strip()
+    description = (row.get('description') or '').strip() or None
+    if not name:
+        raise RowError('missing name')
+    if not category:
+        raise RowError('missing category')
+    if len(name) > 80:
+        raise RowError('name longer than 80 characters')
+    if len(category) > 50:
+        raise RowError('category longer than 50 characters')
+    if description is not None and len(description) > 250:
+        raise RowError('description longer than 250 characters')
+
+    return {
+        'name': name,
+        'description': description,
+        'category': category,
+        'user_email': (row.get('user_email') or '').strip() or None,
+        'user_name': (row.get('user_name') or '').strip() or None,
+    }
+
+
+class Loader(object):
+    """Resolve names to ids and write items in batches"""
+
+    def __init__(self, connection, source, owner_email):
+        self.connection = connection
+        self.source = source
+        self.owner_email = owner_email
+        self.users = dict(connection.execute(
+            text('SELECT email, id FROM "user"')).fetchall())
+        self.categories = dict(connection.execute(
+            text('SELECT name, id FROM category')).fetchall())
+        self.created = Counter()
+
+    def checkpoint(self):
+        """Return how many input rows earlier runs already consumed"""
+
+        return self.connection.execute(
+            text('SELECT rows FROM import_checkpoint WHERE source = :source'),
+            source=self.source).scalar() or 0
+
+    def save_checkpoint(self, rows):
+        self.connection.execute(
+            text('DELETE FROM import_checkpoint WHERE source = :source'),
+            source=self.source)
+        self.connection.execute(
+            text('INSERT INTO import_checkpoint (source, rows) '
+                 'VALUES (:source, :rows)'),
+            source=self.source, rows=rows)
+
+    def user_id(self, email, name):
+        email = email or self.owner_email
+        if email is None:
+            raise RowError('no user_email and no --owner-email given')
+        if email not in self.users:
+            result = self.connection.execute(User.__table__.insert().values(
+                name=name or email.split('@')[0], email=email))
+            self.users[email] = result.inserted_primary_key[0]
+            self.created['users'] += 1
+        return self.users[email]
+
+    def category_id(self, name, user_id):
+        if name not in self.categories:
+            result = self.connection.execute(
+                Category.__table__.insert().values(name=name, user_id=user_id))
+            self.categories[name] = result.inserted_primary_key[0]
+            self.created['categories'] += 1
+        return self.categories[name]
+
+    def resolve(self, row):
+        """Turn a validated row into an item insert"""
+
+        user_id = self.user_id(row['user_email'], row['user_name'])
+        return {
+            'name': row['name'],
+            'description': row['description'],
+            'category_id': self.category_id(row['category'], user_id),
+            'user_id': user_id,
+            'updated_at': datetime.datetime.utcnow(),
+        }
+
+    def write(self, items):
+        """Insert items and add them to the denormalized counts"""
+
+        if items:
+            self.connection.execute(Item.__table__.insert(), items)
+        self.created['items'] += len(items)
+        apply_count_deltas(
+            self.connection,
+            Counter(item['category_id'] for item in items),
+            Counter(item['user_id'] for item in items),
+            self.created)
+        self.created = Counter()
+
+
+def log_import(connection, source, items):
+    """Mark a committed part of a load in the change log
+
+    Loaded items get no change rows of their own; feed clients resync
+    when they see this one.
+    """
+
+    log_batch(connection, [change_row(
+        'catalog', 0, 'import', {'source': source, 'items': items},
+        datetime.datetime.utcnow())])
+
+
+def set_pragmas(connection, pragmas):
+    """Apply SQLite pragmas and return their previous values"""
+
+    previous = {}
+    for name, value in pragmas.items():
+        previous[name] = connection.execute('PRAGMA ' + name).scalar()
+        connection.execute('PRAGMA {} = {}'.format(name, value))
+    return previous
+
+
+def load(path, input_format, owner_email, batch_size, restart,
+         defer_search_index=False):
+    """Load a feed into the catalog, resuming from its checkpoint"""
+
+    source = 'stdin' if path == '-' else os.path.abspath(path)
+    upgrade(engine, Base.metadata)
+    connection = engine.connect()
+    previous = {}
+    if engine.dialect.name == 'sqlite':
+        previous = set_pragmas(connection, LOAD_PRAGMAS)
+        if defer_search_index:
+            for trigger in SEARCH_TRIGGERS:
+                connection.execute('DROP TRIGGER IF EXISTS ' + trigger)
+
+    try:
+        loader = Loader(connection, source, owner_email)
+        if restart:
+            with connection.begin():
+                loader.save_checkpoint(0)
+        skip = loader.checkpoint()
+        if skip:
+            print('Resuming after {} rows'.format(skip), file=sys.stderr)
+
+        consumed = loaded = rejected = batches = logged = 0
+        started = time.time()
+        items = []
+        transaction = connection.begin()
+        for consumed, row in enumerate(read_rows(path, input_format), 1):
+            if consumed <= skip:
+                continue
+            try:
+                items.append(loader.resolve(validate(row)))
+            except RowError as e:
+                rejected += 1
+                print('row {}: {}'.format(consumed, e), file=sys.stderr)
+                continue
+
+            if len(items) >= batch_size:
+                loader.write(items)
+                loaded += len(items)
+                items = []
+                batches += 1
+                if batches % BATCHES_PER_TRANSACTION == 0:
+                    loader.save_checkpoint(consumed)
+                    log_import(connection, source, loaded - logged)
+                    logged = loaded
+                    transaction.commit()
+                    transaction = connection.begin()
+                    report(loaded, started)
+
+        loader.write(items)
+        loaded += len(items)
+        loader.save_checkpoint(max(consumed, skip))
+        log_import(connection, source, loaded - logged)
+        bump_catalog_version(connection)
+        transaction.commit()
+        report(loaded, started)
+        print('Loaded {} items, rejected {} rows'.format(loaded, rejected))
+    finally:
+        if previous:
+            if defer_search_index:
+                print('Rebuilding search index', file=sys.stderr)
+                with connection.begin():
+                    add_item_search_index(connection)
+            set_pragmas(connection, {'synchronous': previous['synchronous']})
+        connection.close()
+
+
+def report(loaded, started):
+    elapsed = max(time.time() - started, 1e-6)
+    print('{} items in {:.1f}s ({:.0f} rows/s)'.format(
+        loaded, elapsed, loaded / elapsed), file=sys.stderr)
+
+
+def generate(rows, categories, users, seed, out=sys.stdout):
+    """Write a synthetic NDJSON feed for benchmarking"""
+
+    rng = random.Random(seed)
+    words = ['alpine', 'board', 'carbon', 'deluxe', 'edge', 'freeride',
+             'glove', 'helmet', 'ice', 'jacket', 'kit', 'lite', 'mountain',
+             'nordic', 'pro', 'racing', 'ski', 'touring', 'ultra', 'wax']
+    for n in range(rows):
+        out.write(json.dumps({
+            'name': '{} {} {}'.format(
+                rng.choice(words).title(), rng.choice(words), n),
+            'description': ' '.join(rng.choice(words) for _ in range(12)),
+            'category': 'Category {}'.format(rng.randrange(categories)),
+            'user_email': 'user{}@example.com'.format(rng.randrange(users)),
+        }) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    load_parser = commands.add_parser('load', help='import a CSV/NDJSON feed')
+    load_parser.add_argument('path', help="input file, or '-' for stdin")
+    load_parser.add_argument('--format', choices=['csv', 'ndjson'])
+    load_parser.add_argument('--owner-email')
+    load_parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    load_parser.add_argument(
+        '--restart', action='store_true',
+        help='ignore the checkpoint of an earlier run')
+    load_parser.add_argument(
+        '--defer-search-index', action='store_true',
+        help='rebuild the search index once after the load')
+
+    gen_parser = commands.add_parser('generate', help='write synthetic NDJSON')
+    gen_parser.add_argument('rows', type=int)
+    gen_parser.add_argument('--categories', type=int, default=100)
+    gen_parser.add_argument('--users', type=int, default=1000)
+    gen_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args(argv)
+    if args.command == 'load':
+        input_format = args.format or (
+            'csv' if args.path.endswith('.csv') else 'ndjson')
+        load(args.path, input_format, args.owner_email, args.batch_size,
+             args.restart, args.defer_search_index)
+    elif args.command == 'generate':
+        generate(args.rows, args.categories, args.users, args.seed)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""Per-request instrumentation exposed in Prometheus text format.
+
+Each request records its wall time, SQL time and query count (from
+cursor execute events), template render time and outbound HTTP time.
+They are aggregated into per-endpoint histograms served at /metrics.
+
+Setting CATALOG_PROFILE_SAMPLE_RATE (0..1) profiles that fraction of
+requests with cProfile and dumps those slower than
+CATALOG_PROFILE_SLOW_MS into CATALOG_PROFILE_DIR. With sampling off the
+only cost is a few clock reads per request and per query.
+"""
+
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+
+import cProfile
+import os
+import random
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('CATALOG_PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_MS = float(os.environ.get('CATALOG_PROFILE_SLOW_MS', 500))
+PROFILE_DIR = os.environ.get('CATALOG_PROFILE_DIR', 'profiles')
+
+
+class Histogram(object):
+    """Cumulative histogram keyed by endpoint"""
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, endpoint, value):
+        with self.lock:
+            series = self.series.get(endpoint)
+            if series is None:
+                series = self.series[endpoint] = [
+                    [0] * len(self.buckets), 0.0, 0]
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][n] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for endpoint, (counts, total, count) in sorted(
+                    self.series.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'
+                                 .format(self.name, endpoint, bound, bucket))
+                lines.append('{}_bucket{{endpoint="{}",le="+Inf"}} {}'
+                             .format(self.name, endpoint, count))
+                lines.append('{}_sum{{endpoint="{}"}} {}'
+                             .format(self.name, endpoint, total))
+                lines.append('{}_count{{endpoint="{}"}} {}'
+                             .format(self.name, endpoint, count))
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    'catalog_request_duration_seconds', 'Request wall time.',
+    LATENCY_BUCKETS)
+SQL_SECONDS = Histogram(
+    'catalog_sql_duration_seconds', 'Time spent in SQL per request.',
+    LATENCY_BUCKETS)
+SQL_QUERIES = Histogram(
+    'catalog_sql_queries', 'SQL statements executed per request.',
+    COUNT_BUCKETS)
+TEMPLATE_SECONDS = Histogram(
+    'catalog_template_render_seconds', 'Template render time per request.',
+    LATENCY_BUCKETS)
+HTTP_SECONDS = Histogram(
+    'catalog_outbound_http_seconds', 'Outbound HTTP time per request.',
+    LATENCY_BUCKETS)
+
+HISTOGRAMS = [REQUEST_SECONDS, SQL_SECONDS, SQL_QUERIES, TEMPLATE_SECONDS,
+              HTTP_SECONDS]
+
+# Extra `name -> callable returning {metric: value}` gauges to expose.
+gauges = {}
+
+
+def current():
+    """Return the running request's counters, or None outside a request"""
+
+    if has_request_context():
+        return g.get('metrics')
+    return None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    context._metrics_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    counters = current()
+    if counters is not None:
+        counters['sql'] += time.perf_counter() - context._metrics_started
+        counters['queries'] += 1
+
+
+class TimedTemplate(Template):
+    """Jinja template that adds its render time to the request"""
+
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            counters = current()
+            if counters is not None:
+                counters['template'] += time.perf_counter() - started
+
+
+@contextmanager
+def timed_http():
+    """Add the time spent in the block to the request's outbound HTTP"""
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        counters = current()
+        if counters is not None:
+            counters['http'] += time.perf_counter() - started
+
+
+def start_request():
+    g.metrics = {
+        'started': time.perf_counter(),
+        'sql': 0.0,
+        'queries': 0,
+        'template': 0.0,
+        'http': 0.0,
+        'profile': None,
+    }
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active on this thread.
+            return
+        g.metrics['profile'] = profile
+
+
+def finish_request(response):
+    counters = g.pop('metrics', None)
+    if counters is None:
+        return response
+    elapsed = time.perf_counter() - counters['started']
+    endpoint = request.endpoint or 'unmatched'
+
+    REQUEST_SECONDS.observe(endpoint, elapsed)
+    SQL_SECONDS.observe(endpoint, counters['sql'])
+    SQL_QUERIES.observe(endpoint, counters['queries'])
+    TEMPLATE_SECONDS.observe(endpoint, counters['template'])
+    HTTP_SECONDS.observe(endpoint, counters['http'])
+
+    profile = counters['profile']
+    if profile is not None:
+        profile.disable()
+        if elapsed * 1000 >= PROFILE_SLOW_MS:
+            dump_profile(profile, endpoint, elapsed)
+    return response
+
+
+def abandon_request(exception=None):
+    """Stop a sampled profile when the request failed before finishing"""
+
+    counters = g.pop('metrics', None)
+    if counters is not None and counters['profile'] is not None:
+        counters['profile'].disable()
+
+
+def dump_profile(profile, endpoint, elapsed):
+    """Write a slow request's profile, readable by pstats or snakeviz"""
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile.dump_stats(os.path.join(PROFILE_DIR, '{}-{}-{:.0f}ms.prof'.format(
+        endpoint, int(time.time() * 1000), elapsed * 1000)))
+
+
+def expose():
+    """Return every metric in Prometheus text format"""
+
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.expose())
+    for prefix, read in sorted(gauges.items()):
+        for name, value in sorted(read().items()):
+            if isinstance(value, (int, float)):
+                lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+                lines.append('{}_{} {}'.format(prefix, name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def instrument_engine(engine):
+    """Time every statement run through `engine`"""
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def init_app(app, engine):
+    """Instrument `app` and `engine`"""
+
+    instrument_engine(engine)
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(abandon_request)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+"""Versioned schema migrations for existing catalog databases.
+
+Run ``python migrations.py`` to upgrade a database in place. New
+databases are created from the models and then run through every
+migration, so each one must be a no-op where its change already exists.
+"""
+
+from sqlalchemy import inspect, text
+
+import sys
+
+
+def add_item_updated_at(connection):
+    """Add item.updated_at"""
+
+    columns = [c['name'] for c in inspect(connection).get_columns('item')]
+    if 'updated_at' not in columns:
+        connection.execute('ALTER TABLE item ADD COLUMN updated_at DATETIME')
+
+
+def index_lookup_columns(connection):
+    """Index lookup columns and make user emails and category names unique"""
+
+    for table, column in (('item', 'name'),
+                          ('item', 'category_id'),
+                          ('item', 'user_id'),
+                          ('item', 'updated_at'),
+                          ('category', 'user_id')):
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON "{0}" ({1})'
+            .format(table, column))
+
+    for table, column in (('user', 'email'), ('category', 'name')):
+        duplicates = connection.execute(
+            'SELECT {1} FROM "{0}" GROUP BY {1} HAVING COUNT(*) > 1'
+            .format(table, column)).fetchall()
+        if duplicates:
+            raise MigrationError(
+                'Cannot make {}.{} unique, duplicated values: {}'.format(
+                    table, column, ', '.join(d[0] for d in duplicates)))
+        connection.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS ix_{0}_{1} ON "{0}" ({1})'
+            .format(table, column))
+
+
+# Matches on the item name outrank matches in the description.
+SEARCH_RANK = 'bm25(10.0, 1.0)'
+
+SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5(
+        name, description,
+        content='item', content_rowid='id',
+        prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_insert AFTER INSERT ON item
+    BEGIN
+        INSERT INTO item_fts (rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_delete AFTER DELETE ON item
+    BEGIN
+        INSERT INTO item_fts (item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS item_fts_update
+    AFTER UPDATE OF name, description ON item
+    BEGIN
+        INSERT INTO item_fts (item_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO item_fts (rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+]
+
+
+def add_item_search_index(connection):
+    """Add the item_fts full-text index and fill it"""
+
+    if connection.dialect.name != 'sqlite':
+        return
+    for statement in SEARCH_DDL:
+        connection.execute(statement)
+    connection.execute(
+        text("INSERT INTO item_fts (item_fts, rank) VALUES ('rank', :rank)"),
+        rank=SEARCH_RANK)
+    connection.execute("INSERT INTO item_fts (item_fts) VALUES ('rebuild')")
+
+
+def add_import_checkpoint(connection):
+    """Add the import_checkpoint table used to resume bulk loads"""
+
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS import_checkpoint ('
+        'source VARCHAR(1024) PRIMARY KEY, rows INTEGER NOT NULL)')
+
+
+def add_item_counts(connection):
+    """Add denormalized item counts and catalog totals"""
+
+    for table in ('category', 'user'):
+        columns = [c['name'] for c in inspect(connection).get_columns(table)]
+        if 'item_count' not in columns:
+            connection.execute(
+                'ALTER TABLE "{}" ADD COLUMN item_count INTEGER '
+                'NOT NULL DEFAULT 0'.format(table))
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS catalog_stats ('
+        'id INTEGER PRIMARY KEY, items INTEGER NOT NULL, '
+        'categories INTEGER NOT NULL, users INTEGER NOT NULL)')
+    recompute_counts(connection)
+
+
+def add_change_log(connection):
+    """Add the catalog_change log behind /api/v1/changes"""
+
+    if connection.dialect.name != 'sqlite':
+        # Created from the model by upgrade()'s final create_all.
+        return
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS catalog_change ('
+        'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'kind VARCHAR(16) NOT NULL, object_id INTEGER NOT NULL, '
+        'action VARCHAR(16) NOT NULL, data TEXT, '
+        'changed_at DATETIME NOT NULL)')
+
+
+def add_item_views(connection):
+    """Add the item_view counters behind the popular items lists"""
+
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS item_view ('
+        'item_id INTEGER NOT NULL PRIMARY KEY, views INTEGER NOT NULL)')
+
+
+def recompute_counts(connection):
+    """Recompute every item count and the catalog totals from scratch"""
+
+    connection.execute(
+        'UPDATE category SET item_count = '
+        '(SELECT COUNT(*) FROM item WHERE item.category_id = category.id)')
+    connection.execute(
+        'UPDATE "user" SET item_count = '
+        '(SELECT COUNT(*) FROM item WHERE item.user_id = "user".id)')
+    connection.execute('DELETE FROM catalog_stats')
+    connection.execute(
+        'INSERT INTO catalog_stats (id, items, categories, users) VALUES (1, '
+        '(SELECT COUNT(*) FROM item), (SELECT COUNT(*) FROM category), '
+        '(SELECT COUNT(*) FROM "user"))')
+
+
+# (version, migration) pairs, applied in order. Never edit or reorder a
+# released entry; append a new one instead.
+MIGRATIONS = [
+    (1, add_item_updated_at),
+    (2, index_lookup_columns),
+    (3, add_item_search_index),
+    (4, add_import_checkpoint),
+    (5, add_item_counts),
+    (6, add_change_log),
+    (7, add_item_views),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+class MigrationError(Exception):
+    """A migration cannot be applied to the data in the database"""
+
+
+def current_version(connection):
+    """Return the schema version stored in the database"""
+
+    if 'schema_version' not in inspect(connection).get_table_names():
+        return 0
+    return connection.execute(
+        'SELECT version FROM schema_version').scalar() or 0
+
+
+def stamp(connection, version):
+    """Record the schema version in the database"""
+
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS schema_version (version INTEGER)')
+    connection.execute('DELETE FROM schema_version')
+    connection.execute(
+        text('INSERT INTO schema_version (version) VALUES (:version)'),
+        version=version)
+
+
+def upgrade(engine, metadata):
+    """Create a new database or bring an existing one up to date"""
+
+    with engine.begin() as connection:
+        if 'item' not in inspect(connection).get_table_names():
+            metadata.create_all(connection)
+
+    version = current_version(engine)
+    for target, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        # Each step commits on its own so a failure keeps earlier ones.
+        with engine.begin() as connection:
+            migration(connection)
+            stamp(connection, target)
+        print('Applied migration {}: {}'.format(
+            target, migration.__doc__), file=sys.stderr)
+
+    # Tables added by later models need no data migration.
+    metadata.create_all(engine)
+
+
+if __name__ == '__main__':
+    from database_setup import Base
+    from db import engine
+
+    upgrade(engine, Base.metadata)
+    print('Database schema is at version {}'.format(LATEST_VERSION))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""Google OAuth calls used by the login views.
+
+client_secrets.json is parsed once, on first use. Outbound calls share
+one pooled keep-alive requests session with timeouts, tokeninfo and
+userinfo are fetched concurrently, and validated tokens are cached until
+they expire or CATALOG_TOKEN_CACHE_TTL passes.
+
+oauth2client, httplib2 and requests are only imported by the login
+views, so processes serving read traffic never load them.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from cache import LRUCache
+
+import json
+import os
+import threading
+
+CLIENT_SECRETS_FILE = os.environ.get(
+    'CATALOG_CLIENT_SECRETS', 'client_secrets.json')
+
+TOKENINFO_URL = os.environ.get(
+    'CATALOG_TOKENINFO_URL', 'https://www.googleapis.com/oauth2/v1/tokeninfo')
+USERINFO_URL = os.environ.get(
+    'CATALOG_USERINFO_URL', 'https://www.googleapis.com/oauth2/v1/userinfo')
+REVOKE_URL = os.environ.get(
+    'CATALOG_REVOKE_URL', 'https://accounts.google.com/o/oauth2/revoke')
+
+HTTP_TIMEOUT = float(os.environ.get('CATALOG_HTTP_TIMEOUT', 5))
+HTTP_POOL_SIZE = int(os.environ.get('CATALOG_HTTP_POOL_SIZE', 20))
+
+token_cache = LRUCache(
+    max_entries=10000,
+    ttl=int(os.environ.get('CATALOG_TOKEN_CACHE_TTL', 300)))
+
+_secrets = None
+_http_session = None
+_lock = threading.Lock()
+_local = threading.local()
+
+executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE)
+
+
+def client_secrets():
+    """Return the `web` section of client_secrets.json, read once"""
+
+    global _secrets
+    if _secrets is None:
+        with _lock:
+            if _secrets is None:
+                with open(CLIENT_SECRETS_FILE, 'r') as f:
+                    _secrets = json.load(f)['web']
+    return _secrets
+
+
+def client_id():
+    return client_secrets()['client_id']
+
+
+def http_session():
+    """Return the shared pooled requests session, created on first use"""
+
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                for prefix in ('https://', 'http://'):
+                    session.mount(prefix, HTTPAdapter(
+                        pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+                _http_session = session
+    return _http_session
+
+
+def thread_http():
+    """Return this thread's keep-alive httplib2 client for oauth2client"""
+
+    http = getattr(_local, 'http', None)
+    if http is None:
+        import httplib2
+        http = _local.http = httplib2.Http(timeout=HTTP_TIMEOUT)
+    return http
+
+
+def exchange_code(code):
+    """Upgrade a one-time authorization code into credentials
+
+    Raises oauth2client's FlowExchangeError on failure.
+    """
+
+    from oauth2client.client import OAuth2WebServerFlow
+
+    secrets = client_secrets()
+    flow = OAuth2WebServerFlow(
+        client_id=secrets['client_id'],
+        client_secret=secrets['client_secret'],
+        scope='',
+        redirect_uri='postmessage',
+        auth_uri=secrets['auth_uri'],
+        token_uri=secrets['token_uri'])
+    return flow.step2_exchange(code, http=thread_http())
+
+
+def get_json(url, params):
+    return http_session().get(
+        url, params=params, timeout=HTTP_TIMEOUT).json()
+
+
+def validate_token(access_token):
+    """Return (tokeninfo, userinfo) for an access token
+
+    Both are requested at once; results without an error are cached.
+    """
+
+    cached = token_cache.get(access_token)
+    if cached is not None:
+        return cached
+
+    tokeninfo = executor.submit(
+        get_json, TOKENINFO_URL, {'access_token': access_token})
+    userinfo = executor.submit(
+        get_json, USERINFO_URL, {'access_token': access_token, 'alt': 'json'})
+    result = (tokeninfo.result(), userinfo.result())
+
+    if result[0].get('error') is None:
+        expires_in = int(result[0].get('expires_in', token_cache.ttl))
+        token_cache.set(
+            access_token, result, ttl=min(token_cache.ttl, expires_in))
+    return result
+
+
+def revoke_token(access_token):
+    """Revoke an access token; return True when Google accepted it"""
+
+    token_cache.delete(access_token)
+    response = http_session().get(
+        REVOKE_URL, params={'token': access_token}, timeout=HTTP_TIMEOUT)
+    return response.status_code == 200
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""Item view counts and the popular items lists.
+
+Viewing an item only bumps a counter in memory, or in Redis when
+CATALOG_VIEW_COUNTER_STORE is a redis:// URL shared by all workers:
+
+    memory          default, per process
+    redis://...     a Redis server
+
+A background thread adds the pending counts to the item_view table every
+CATALOG_VIEW_FLUSH_INTERVAL seconds in one batched upsert, so page views
+never wait on the database's writer lock. Every
+CATALOG_POPULAR_REFRESH_INTERVAL seconds it also re-ranks the most
+viewed items per category. Pages read the ranking from memory.
+
+Pending counts are flushed when the process shuts down cleanly; a crash
+loses at most one flush interval of them.
+"""
+
+from collections import Counter, namedtuple
+from functools import wraps
+from flask import current_app, request
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from database_setup import Item, ItemViews
+from db import engine
+
+import atexit
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+FLUSH_INTERVAL = float(os.environ.get('CATALOG_VIEW_FLUSH_INTERVAL', 10))
+REFRESH_INTERVAL = float(
+    os.environ.get('CATALOG_POPULAR_REFRESH_INTERVAL', 60))
+
+# Items in each popular list.
+POPULAR_SIZE = int(os.environ.get('CATALOG_POPULAR_SIZE', 5))
+
+UPSERT = text(
+    'INSERT INTO item_view (item_id, views) VALUES (:item_id, :views) '
+    'ON CONFLICT (item_id) DO UPDATE '
+    'SET views = item_view.views + excluded.views')
+
+PopularItem = namedtuple('PopularItem', 'id name category_id views')
+
+
+class MemoryViewCounter(object):
+    """Pending view counts kept in this process"""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, counts):
+        with self.lock:
+            self.counts.update(counts)
+
+    def take(self):
+        """Return and reset the pending counts"""
+
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+        return counts
+
+    def pending(self):
+        return len(self.counts)
+
+
+class RedisViewCounter(object):
+    """Pending view counts shared by every worker through Redis"""
+
+    def __init__(self, client, key='catalog:views'):
+        self.client = client
+        self.key = key
+
+    def add(self, counts):
+        pipe = self.client.pipeline(transaction=False)
+        for item_id, views in counts.items():
+            pipe.hincrby(self.key, item_id, views)
+        pipe.execute()
+
+    def take(self):
+        # Read and delete in one transaction, so no increment falls
+        # between them.
+        pipe = self.client.pipeline()
+        pipe.hgetall(self.key)
+        pipe.delete(self.key)
+        counts, _ = pipe.execute()
+        return Counter({int(k): int(v) for k, v in counts.items()})
+
+    def pending(self):
+        return self.client.hlen(self.key)
+
+
+def make_counter(store):
+    """Return the counter for a CATALOG_VIEW_COUNTER_STORE value"""
+
+    if store == 'memory':
+        return MemoryViewCounter()
+    if store.startswith('redis://'):
+        if redis is None:
+            raise RuntimeError('The redis package is needed for ' + store)
+        return RedisViewCounter(redis.Redis.from_url(store))
+    raise ValueError('Unknown view counter store: ' + store)
+
+
+def rank(connection, size=POPULAR_SIZE):
+    """Return the `size` most viewed items of every category, and overall"""
+
+    views = ItemViews.__table__
+    item = Item.__table__
+    ranked = select([
+        item.c.id, item.c.name, item.c.category_id, views.c.views,
+        func.row_number().over(
+            partition_by=item.c.category_id,
+            order_by=(views.c.views.desc(), item.c.id)).label('position'),
+    ]).select_from(views.join(item, item.c.id == views.c.item_id)).alias()
+    rows = connection.execute(
+        select([ranked.c.id, ranked.c.name, ranked.c.category_id,
+                ranked.c.views])
+        .where(ranked.c.position <= size)
+        .order_by(ranked.c.views.desc(), ranked.c.id))
+
+    popular = {}
+    for row in rows:
+        popular.setdefault(row.category_id, []).append(PopularItem(*row))
+    # The overall leaders are each among their category's leaders.
+    everything = sorted(
+        (i for items in popular.values() for i in items),
+        key=lambda i: (-i.views, i.id))
+    popular[None] = everything[:size]
+    return popular
+
+
+def ranking_version(popular):
+    """Hash of a ranking: the same in every process that ranked the
+    same counts"""
+
+    entries = sorted(
+        (category_id is not None, category_id or 0,
+         tuple((i.id, i.views) for i in items))
+        for category_id, items in popular.items())
+    return hashlib.sha1(repr(entries).encode()).hexdigest()[:16]
+
+
+def prune(connection):
+    """Drop the counts of deleted items"""
+
+    views = ItemViews.__table__
+    item = Item.__table__
+    connection.execute(views.delete().where(
+        ~views.c.item_id.in_(select([item.c.id]))))
+
+
+class ViewTracker(object):
+    """Count item views and keep the popular lists, one thread per process"""
+
+    def __init__(self, engine, counter, flush_interval=FLUSH_INTERVAL,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.engine = engine
+        self.counter = counter
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.popular = {}
+        # Hash of the ranking; part of the pages' ETags and cache keys.
+        self.version = ranking_version(self.popular)
+        self.refreshed_at = 0.0
+        self.flushed = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Load the ranking and start flushing, once per process"""
+
+        with self.lock:
+            if self.thread is not None:
+                return
+            if not self.refreshed_at:
+                self.refresh()
+            self.thread = threading.Thread(
+                target=self.run, name='view-tracker', daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def run(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+            if time.monotonic() - self.refreshed_at >= self.refresh_interval:
+                self.refresh()
+
+    def stop(self):
+        """Flush pending counts; call on clean shutdown"""
+
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def hit(self, item_id):
+        if self.thread is None:
+            self.start()
+        self.counter.add({item_id: 1})
+
+    def flush(self):
+        """Add the pending counts to item_view in one transaction"""
+
+        with self.flush_lock:
+            counts = self.counter.take()
+            if not counts:
+                return
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(UPSERT, [
+                        {'item_id': item_id, 'views': views}
+                        for item_id, views in sorted(counts.items())])
+            except SQLAlchemyError:
+                # Keep them for the next flush.
+                self.counter.add(counts)
+                return
+            self.flushed += sum(counts.values())
+
+    def refresh(self):
+        """Re-rank the popular items from item_view"""
+
+        try:
+            with self.engine.begin() as connection:
+                prune(connection)
+                popular = rank(connection)
+        except SQLAlchemyError:
+            popular = self.popular
+        self.refreshed_at = time.monotonic()
+        if popular != self.popular:
+            self.popular = popular
+            self.version = ranking_version(popular)
+
+    def ranking_version(self):
+        """The version of the ranking pages are built from"""
+
+        if self.thread is None:
+            self.start()
+        return self.version
+
+    def popular_items(self, category_id=None):
+        """The most viewed items of a category, or of the whole catalog"""
+
+        if self.thread is None:
+            self.start()
+        return self.popular.get(category_id, ())
+
+    def stats(self):
+        return {
+            'pending': self.counter.pending(),
+            'flushed': self.flushed,
+            'ranking_version': self.version,
+        }
+
+
+def counts_views(view):
+    """Count views of the item page, including those the caches answer
+
+    Only pages actually shown count, so walking missing ids adds
+    nothing to the counter or to item_view.
+    """
+
+    @wraps(view)
+    def wrapper(item_id, **kwargs):
+        response = current_app.make_response(view(item_id=item_id, **kwargs))
+        if request.method == 'GET' and response.status_code in (200, 304):
+            tracker.hit(item_id)
+        return response
+    return wrapper
+
+
+tracker = ViewTracker(
+    engine,
+    make_counter(os.environ.get('CATALOG_VIEW_COUNTER_STORE', 'memory')))
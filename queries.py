@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""Read queries for the views, each answered in one or two round trips."""
+
+from sqlalchemy.orm import joinedload
+from database_setup import CatalogStats, CatalogVersion, Category, Item
+from db import Session
+
+
+def get_catalog_version():
+    """Return the catalog version and when it last changed"""
+
+    row = Session.query(CatalogVersion.version, CatalogVersion.updated_at)\
+        .first()
+    if row is None:
+        return 0, None
+    return row
+
+
+def get_catalog_stats():
+    """Return the catalog totals row, or None before the first write"""
+
+    return Session.query(CatalogStats).first()
+
+
+def get_item_with_relations(item_id):
+    """Return an item with its category and owner loaded, or None"""
+
+    return Session.query(Item)\
+        .options(joinedload(Item.category), joinedload(Item.user))\
+        .filter(Item.id == item_id).first()
+
+
+def get_item(item_id):
+    """Return an item without its relations, or None"""
+
+    return Session.query(Item).filter(Item.id == item_id).first()
+
+
+def get_category(category_id):
+    """Return a category, or None"""
+
+    return Session.query(Category).filter(Category.id == category_id).first()
+
+
+# The columns behind Item.serialize and Category.serialize, for JSON
+# endpoints that skip building ORM objects.
+ITEM_COLUMNS = (
+    Item.id, Item.name, Item.description, Item.user_id, Item.category_id)
+CATEGORY_COLUMNS = (Category.id, Category.name, Category.user_id)
+
+
+def serialize_rows(rows):
+    """Return column-only query rows as dicts, like the models' serialize"""
+
+    if not rows:
+        return []
+    keys = rows[0].keys()
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def get_item_page(query, limit, after=None):
+    """Return one page of items, newest first, and the next cursor"""
+
+    if after is not None:
+        query = query.filter(Item.id < after)
+
+    # Fetch one extra row to learn whether another page follows.
+    items = query.order_by(Item.id.desc()).limit(limit + 1).all()
+    if len(items) > limit:
+        return items[:limit], items[limit - 1].id
+    return items, None
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+"""Admission control: per-client rate limits and load shedding.
+
+Every request draws a token from a bucket of its route, keyed by the
+logged-in user id or else by the client IP. A bucket holds up to N
+tokens and refills at N per period, so "120/minute" allows bursts of
+120 and then two requests a second. An empty bucket answers 429 with a
+Retry-After header before the view runs. Buckets live in the process,
+or in Redis when CATALOG_RATE_LIMIT_STORE is a redis:// URL so that
+all workers share them:
+
+    memory          default, per process
+    redis://...     a Redis server
+    off             no rate limits
+
+Routes declare their limit and cost with ``@rate_limit('60/minute',
+cost=HIGH)``; CATALOG_RATE_LIMITS overrides limits by endpoint name.
+
+When too many requests are in flight or the recent p99 latency is over
+its target, the costliest routes are shed first with 503s, and cheaper
+ones only if the overload grows.
+"""
+
+from flask import Response, g, request
+from flask import session as login_session
+
+import collections
+import math
+import os
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Route costs. Shedding starts with HIGH; CHEAP routes are never shed
+# or rate limited.
+CHEAP, LOW, NORMAL, HIGH = 0, 1, 2, 3
+
+DEFAULT_LIMIT = os.environ.get('CATALOG_RATE_LIMIT_DEFAULT', '300/minute')
+
+# In-flight requests per process, and recent p99 latency, at which
+# shedding starts; 0 turns either check off.
+MAX_IN_FLIGHT = int(os.environ.get('CATALOG_SHED_MAX_IN_FLIGHT', 64))
+P99_TARGET = float(os.environ.get('CATALOG_SHED_P99_MS', 1000)) / 1000
+
+# Latencies of the last LATENCY_WINDOW seconds (at most LATENCY_SAMPLES
+# of them) make up the p99, which is recomputed at most every
+# P99_INTERVAL seconds.
+LATENCY_WINDOW = 10
+LATENCY_SAMPLES = 10000
+P99_INTERVAL = 1
+
+# Each further half of overload sheds the next cheaper cost.
+SHED_STEP = 0.5
+
+# Retry-After, in seconds, of a shed request.
+SHED_RETRY_AFTER = 1
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(value):
+    """Parse "N/period" into (burst, tokens per second); None is off"""
+
+    if value is None or value == 'off':
+        return None
+    count, period = value.split('/')
+    seconds = PERIODS.get(period)
+    if seconds is None:
+        seconds = float(period)
+    return int(count), int(count) / seconds
+
+
+def parse_overrides(value):
+    """Parse CATALOG_RATE_LIMITS: "endpoint=N/period,..." """
+
+    overrides = {}
+    for entry in filter(None, value.split(',')):
+        endpoint, limit = entry.split('=')
+        overrides[endpoint.strip()] = parse_limit(limit.strip())
+    return overrides
+
+
+DEFAULT_BUCKET = parse_limit(DEFAULT_LIMIT)
+OVERRIDES = parse_overrides(os.environ.get('CATALOG_RATE_LIMITS', ''))
+
+
+def rate_limit(limit=DEFAULT_LIMIT, cost=NORMAL):
+    """Set a view's rate limit ("N/period" or None) and shedding cost"""
+
+    def decorator(view):
+        view.rate_limit = parse_limit(limit)
+        view.cost = cost
+        return view
+    return decorator
+
+
+class MemoryBuckets(object):
+    """Token buckets kept in this process"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, burst, rate):
+        """Take a token; return 0, or the seconds until one is available"""
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            # Least recently used clients first; theirs are full again.
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class RedisBuckets(object):
+    """Token buckets shared by every worker through Redis"""
+
+    # Runs atomically in Redis: refill, take, and report the wait in ms.
+    SCRIPT = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens),
+           'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return wait
+"""
+
+    def __init__(self, client, prefix='catalog:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        self.script = client.register_script(self.SCRIPT)
+
+    def take(self, key, burst, rate):
+        # Wall clock, so that workers on different hosts agree.
+        wait = self.script(
+            keys=[self.prefix + key], args=[burst, rate, time.time()])
+        return int(wait) / 1000
+
+
+def make_buckets(store):
+    """Return the bucket store for a CATALOG_RATE_LIMIT_STORE value"""
+
+    if store == 'off':
+        return None
+    if store == 'memory':
+        return MemoryBuckets()
+    if store.startswith('redis://'):
+        if redis is None:
+            raise RuntimeError('The redis package is needed for ' + store)
+        return RedisBuckets(redis.Redis.from_url(store))
+    raise ValueError('Unknown rate limit store: ' + store)
+
+
+class LoadMonitor(object):
+    """Requests in flight and recent latencies of this process"""
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, p99_target=P99_TARGET):
+        self.max_in_flight = max_in_flight
+        self.p99_target = p99_target
+        self.in_flight = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.p99 = 0.0
+        self.computed_at = 0.0
+        self.lock = threading.Lock()
+        self.limited = 0
+        self.shed = 0
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish(self, elapsed):
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight -= 1
+            self.latencies.append((now, elapsed))
+            if now - self.computed_at >= P99_INTERVAL:
+                self.compute_p99(now)
+
+    def compute_p99(self, now):
+        while self.latencies and \
+                self.latencies[0][0] < now - LATENCY_WINDOW:
+            self.latencies.popleft()
+        values = sorted(elapsed for _, elapsed in self.latencies)
+        self.p99 = values[int(len(values) * 0.99)] if values else 0.0
+        self.computed_at = now
+
+    def overload(self):
+        """How far over the thresholds this process is; 1 is at them"""
+
+        with self.lock:
+            if self.computed_at and \
+                    time.monotonic() - self.computed_at > LATENCY_WINDOW:
+                # Nothing finished lately; don't shed on an old p99.
+                self.compute_p99(time.monotonic())
+            overload = 0
+            if self.max_in_flight:
+                overload = self.in_flight / self.max_in_flight
+            if self.p99_target:
+                overload = max(overload, self.p99 / self.p99_target)
+            return overload
+
+    def shed_cost(self):
+        """Lowest route cost being shed, or None"""
+
+        overload = self.overload()
+        if overload < 1:
+            return None
+        return max(LOW, HIGH - int((overload - 1) / SHED_STEP))
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'p99_seconds': self.p99,
+            'limited': self.limited,
+            'shed': self.shed,
+        }
+
+
+buckets = make_buckets(os.environ.get('CATALOG_RATE_LIMIT_STORE', 'memory'))
+monitor = LoadMonitor()
+
+
+def client_key():
+    user_id = login_session.get('user_id')
+    if user_id is not None:
+        return 'user:{}'.format(user_id)
+    return 'ip:{}'.format(request.remote_addr)
+
+
+def reject(status, message, retry_after):
+    return Response(
+        message + '\n', status=status, mimetype='text/plain',
+        headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+
+def make_admit(app):
+    def admit():
+        """before_request hook: shed or rate limit, else count the request"""
+
+        view = app.view_functions.get(request.endpoint)
+        cost = getattr(view, 'cost', NORMAL)
+        if cost == CHEAP:
+            return None
+
+        shed_cost = monitor.shed_cost()
+        if shed_cost is not None and cost >= shed_cost:
+            monitor.shed += 1
+            return reject(503, 'Server busy, try again shortly.',
+                          SHED_RETRY_AFTER)
+
+        limit = OVERRIDES.get(
+            request.endpoint, getattr(view, 'rate_limit', DEFAULT_BUCKET))
+        if buckets is not None and limit is not None:
+            burst, rate = limit
+            wait = buckets.take(
+                '{}:{}'.format(request.endpoint, client_key()), burst, rate)
+            if wait:
+                monitor.limited += 1
+                return reject(429, 'Too many requests.', wait)
+
+        g.admitted_at = time.perf_counter()
+        monitor.start()
+        return None
+    return admit
+
+
+def release(exception=None):
+    """teardown_request hook: record an admitted request's latency"""
+
+    started = g.pop('admitted_at', None)
+    if started is not None:
+        monitor.finish(time.perf_counter() - started)
+
+
+def init_app(app):
+    # First, so rejected requests cost as little as possible.
+    app.before_request_funcs.setdefault(None, []).insert(0, make_admit(app))
+    app.teardown_request(release)
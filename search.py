@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""Full-text item search on an SQLite FTS5 index.
+
+``item_fts`` is an external-content FTS5 table over ``item.name`` and
+``item.description``, kept in sync by triggers so every write path
+(views, imports, raw SQL) updates it. Run ``python search.py rebuild``
+to re-index an existing database.
+
+Every match is ranked by BM25. Setting CATALOG_SEARCH_CANDIDATES to N
+ranks matches N at a time instead, newest first: the first pages are
+the best of the newest N, later pages continue with the next N, and so
+on. That skips sorting every match of a common word, at the price of
+older, better matches coming later.
+"""
+
+from sqlalchemy import text
+from database_setup import Item
+from db import Session
+from migrations import add_item_search_index
+
+import os
+import re
+
+# Matches ranked together, newest first; 0 ranks all of them at once.
+CANDIDATES = int(os.environ.get('CATALOG_SEARCH_CANDIDATES', 0))
+
+SEARCH_SQL = """
+    SELECT item.* FROM item_fts JOIN item ON item.id = item_fts.rowid
+    WHERE item_fts MATCH :query {category_filter}
+    ORDER BY rank, item.id DESC
+    LIMIT :limit OFFSET :offset
+"""
+
+# One window of CANDIDATES matches. CROSS JOIN keeps item_fts the outer
+# loop, so its rowid order serves the window's LIMIT.
+WINDOW_SQL = """
+    SELECT item.* FROM (
+        SELECT item_fts.rowid AS id, item_fts.rank AS rank
+        FROM item_fts {category_join}
+        WHERE item_fts MATCH :query {category_filter}
+        ORDER BY item_fts.rowid DESC
+        LIMIT :candidates OFFSET :skipped
+    ) AS hits JOIN item ON item.id = hits.id
+    ORDER BY hits.rank, hits.id DESC
+    LIMIT :limit OFFSET :offset
+"""
+
+
+def match_expression(terms):
+    """Turn free text into an FTS5 query: every word, the last as a prefix"""
+
+    words = re.findall(r'\w+', terms, re.UNICODE)
+    if not words:
+        return None
+    quoted = ['"{}"'.format(word) for word in words]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def search_items(terms, category_id=None, limit=20, page=1):
+    """Return one page of items matching `terms`, best match first
+
+    One extra item is fetched so callers can tell whether another page
+    follows.
+    """
+
+    query = match_expression(terms)
+    if query is None:
+        return []
+
+    offset = (page - 1) * limit
+    if Session.bind.dialect.name != 'sqlite':
+        # No FTS5 elsewhere; fall back to an unranked substring match.
+        items = Session.query(Item).filter(
+            Item.name.ilike('%' + terms + '%') |
+            Item.description.ilike('%' + terms + '%'))
+        if category_id is not None:
+            items = items.filter(Item.category_id == category_id)
+        return items.order_by(Item.id.desc())\
+            .offset(offset).limit(limit + 1).all()
+
+    params = {'query': query}
+    category_join = category_filter = ''
+    if category_id is not None:
+        category_join = 'CROSS JOIN item ON item.id = item_fts.rowid'
+        category_filter = 'AND item.category_id = :category_id'
+        params['category_id'] = category_id
+    if not CANDIDATES:
+        statement = text(SEARCH_SQL.format(category_filter=category_filter))
+        return Session.query(Item).from_statement(statement).params(
+            limit=limit + 1, offset=offset, **params).all()
+
+    statement = text(WINDOW_SQL.format(
+        category_join=category_join, category_filter=category_filter))
+    items = []
+    window, skip = divmod(offset, CANDIDATES)
+    while len(items) < limit + 1:
+        wanted = limit + 1 - len(items)
+        found = Session.query(Item).from_statement(statement).params(
+            candidates=CANDIDATES, skipped=window * CANDIDATES,
+            limit=wanted, offset=skip, **params).all()
+        items.extend(found)
+        if len(found) == wanted or skip + len(found) < CANDIDATES:
+            # The page is full, or this window held the last matches.
+            break
+        window += 1
+        skip = 0
+    return items
+
+
+if __name__ == '__main__':
+    import sys
+    from db import engine
+
+    if sys.argv[1:] != ['rebuild']:
+        sys.exit('usage: python search.py rebuild')
+    with engine.begin() as connection:
+        add_item_search_index(connection)
+    print('Search index rebuilt')
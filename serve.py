@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""Production server: a pre-forked pool of worker processes.
+
+    python serve.py --workers 4 --port 5000
+
+The app (models, migrations, templates) is imported once in the master
+before forking. Each worker then serves the shared listening socket
+with a thread per request and opens its own database connections; no
+pooled connection crosses the fork.
+
+SIGTERM or SIGINT drains the workers: they end live change streams and
+/readyz returns 503 for CATALOG_DRAIN_SECONDS so load balancers stop
+routing to them, then they stop accepting, finish in-flight requests
+and exit. A worker that dies is replaced.
+"""
+
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+WORKERS = int(os.environ.get('CATALOG_WORKERS', os.cpu_count() or 1))
+
+# Seconds a draining worker keeps serving while /readyz reports 503.
+DRAIN_SECONDS = float(os.environ.get('CATALOG_DRAIN_SECONDS', 5))
+
+# Seconds to wait for drained workers to exit before killing them.
+GRACEFUL_TIMEOUT = float(os.environ.get('CATALOG_GRACEFUL_TIMEOUT', 30))
+
+
+def listen(host, port, backlog=1024):
+    """Open the listening socket the workers share"""
+
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def run_worker(flask_app, sock, host):
+    """Serve on `sock` until SIGTERM, then drain and return"""
+
+    from werkzeug.serving import make_server
+    from changes import feed
+    from db import engine
+    from popularity import tracker
+
+    # Ctrl-C reaches the whole process group; the master turns it into
+    # an orderly SIGTERM for each worker.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    server = make_server(host, 0, flask_app, threaded=True,
+                         fd=sock.fileno())
+    # Every worker wakes up for a new connection; only one accept() can
+    # win, and the others must not block in it.
+    server.socket.setblocking(False)
+    # Request threads are joined on close rather than killed on exit.
+    server.daemon_threads = False
+
+    def drain():
+        time.sleep(DRAIN_SECONDS)
+        server.shutdown()
+
+    def on_term(signum, frame):
+        flask_app.config['DRAINING'] = True
+        # Live change streams would otherwise hold their threads, and
+        # server_close(), forever; clients resume on another worker.
+        feed.close()
+        threading.Thread(target=drain, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_term)
+    server.serve_forever()
+    # os._exit() skips atexit. Write pending view counts before waiting
+    # on request threads, so a stuck one cannot lose them, and again
+    # for the views those threads counted.
+    tracker.stop()
+    server.server_close()
+    tracker.flush()
+    engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    args = parser.parse_args(argv)
+
+    sock = listen(args.host, args.port)
+
+    # Preload everything the workers share.
+    from app import create_app
+    from db import Session, engine
+
+    flask_app = create_app()
+    # Close the connections the import used, so children start with
+    # empty pools of their own.
+    Session.remove()
+    engine.dispose()
+
+    workers = {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(flask_app, sock, args.host)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        workers[pid] = time.time()
+
+    def on_stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+
+    print('Serving on {}:{} with {} workers'.format(
+        args.host, args.port, args.workers), file=sys.stderr)
+    while not stopping:
+        while len(workers) < args.workers:
+            spawn()
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            started = workers.pop(pid, time.time())
+            print('Worker {} exited with status {}'.format(pid, status),
+                  file=sys.stderr)
+            if time.time() - started < 1:
+                # Don't spin if workers die on start.
+                time.sleep(1)
+        else:
+            time.sleep(0.2)
+
+    print('Draining {} workers'.format(len(workers)), file=sys.stderr)
+    for pid in workers:
+        os.kill(pid, signal.SIGTERM)
+    deadline = time.time() + DRAIN_SECONDS + GRACEFUL_TIMEOUT
+    while workers and time.time() < deadline:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            workers.pop(pid, None)
+        else:
+            time.sleep(0.1)
+    for pid in workers:
+        os.kill(pid, signal.SIGKILL)
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+"""Server-side Flask sessions.
+
+The browser only holds an opaque random session id; the session data
+lives in the catalog database (``web_session`` table) or in Redis,
+chosen by CATALOG_SESSION_STORE:
+
+    database        default, the web_session table
+    redis://...     a Redis server
+    cookie          Flask's signed cookie sessions
+
+Logging in or out gives the session a new id (``regenerate()``) and
+deletes the old one, so an id planted before login is worthless.
+"""
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from sqlalchemy import text
+from werkzeug.datastructures import CallbackDict
+
+import datetime
+import random
+import secrets
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Chance that a save also purges expired rows from the database store.
+PURGE_CHANCE = 0.01
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session dict that remembers its id and whether it changed"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Id to delete from the store when this session is saved.
+        self.previous_sid = None
+
+    def regenerate(self):
+        """Move the session to a fresh id"""
+
+        if not self.new and self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class DatabaseSessionStore(object):
+    """Sessions kept in the web_session table"""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def load(self, sid):
+        return self.engine.execute(
+            text('SELECT data FROM web_session '
+                 'WHERE id = :sid AND expires_at > :now'),
+            sid=sid, now=datetime.datetime.utcnow()).scalar()
+
+    def save(self, sid, data, lifetime):
+        now = datetime.datetime.utcnow()
+        with self.engine.begin() as connection:
+            connection.execute(
+                text('DELETE FROM web_session WHERE id = :sid'), sid=sid)
+            connection.execute(
+                text('INSERT INTO web_session (id, data, expires_at) '
+                     'VALUES (:sid, :data, :expires_at)'),
+                sid=sid, data=data, expires_at=now + lifetime)
+            if random.random() < PURGE_CHANCE:
+                connection.execute(
+                    text('DELETE FROM web_session WHERE expires_at <= :now'),
+                    now=now)
+
+    def delete(self, sid):
+        self.engine.execute(
+            text('DELETE FROM web_session WHERE id = :sid'), sid=sid)
+
+
+class RedisSessionStore(object):
+    """Sessions kept in Redis, expired by Redis itself"""
+
+    def __init__(self, client, prefix='catalog:session:'):
+        self.client = client
+        self.prefix = prefix
+
+    def load(self, sid):
+        data = self.client.get(self.prefix + sid)
+        return data.decode('utf-8') if data is not None else None
+
+    def save(self, sid, data, lifetime):
+        self.client.setex(self.prefix + sid, lifetime, data)
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keep session data in a store and only its id in the cookie"""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSession(self.serializer.loads(data), sid=sid)
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.previous_sid is not None:
+            self.store.delete(session.previous_sid)
+
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(
+                    app.session_cookie_name, domain=domain, path=path)
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        self.store.save(
+            session.sid,
+            self.serializer.dumps(dict(session)),
+            app.permanent_session_lifetime)
+        response.set_cookie(
+            app.session_cookie_name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+
+
+def regenerate(session):
+    """Give a server-side session a new id; call when its user logs in
+    or out. Cookie sessions hold no id to fix."""
+
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+
+
+def make_session_interface(store, engine):
+    """Return the session interface for a CATALOG_SESSION_STORE value"""
+
+    if store == 'cookie':
+        return None
+    if store == 'database':
+        return ServerSessionInterface(DatabaseSessionStore(engine))
+    if store.startswith('redis://'):
+        if redis is None:
+            raise RuntimeError('The redis package is needed for ' + store)
+        return ServerSessionInterface(
+            RedisSessionStore(redis.Redis.from_url(store)))
+    raise ValueError('Unknown session store: ' + store)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+"""Check or repair the denormalized item counts and catalog totals.
+
+    python stats.py check     report counts that drifted from the data
+    python stats.py repair    recompute every count from scratch
+"""
+
+from db import engine
+from migrations import recompute_counts
+
+import sys
+
+DRIFT_QUERIES = [
+    ('category', 'SELECT id, item_count, (SELECT COUNT(*) FROM item '
+                 'WHERE item.category_id = category.id) FROM category'),
+    ('user', 'SELECT id, item_count, (SELECT COUNT(*) FROM item '
+             'WHERE item.user_id = "user".id) FROM "user"'),
+    ('catalog', "SELECT 'items', items, (SELECT COUNT(*) FROM item) "
+                "FROM catalog_stats UNION ALL "
+                "SELECT 'categories', categories, "
+                "(SELECT COUNT(*) FROM category) FROM catalog_stats "
+                "UNION ALL "
+                "SELECT 'users', users, (SELECT COUNT(*) FROM \"user\") "
+                "FROM catalog_stats"),
+]
+
+
+def check_counts(connection):
+    """Return (table, key, stored, actual) for every drifted count"""
+
+    drift = []
+    for table, query in DRIFT_QUERIES:
+        for key, stored, actual in connection.execute(query):
+            if stored != actual:
+                drift.append((table, key, stored, actual))
+    if not connection.execute('SELECT 1 FROM catalog_stats').first():
+        drift.append(('catalog', 'row', None, 'missing'))
+    return drift
+
+
+if __name__ == '__main__':
+    from database_setup import Base
+    from migrations import upgrade
+
+    upgrade(engine, Base.metadata)
+
+    if sys.argv[1:] == ['check']:
+        drift = check_counts(engine)
+        for table, key, stored, actual in drift:
+            print('{} {}: stored {}, actual {}'.format(
+                table, key, stored, actual))
+        print('{} drifted counts'.format(len(drift)))
+        sys.exit(1 if drift else 0)
+    elif sys.argv[1:] == ['repair']:
+        with engine.begin() as connection:
+            recompute_counts(connection)
+        print('Counts recomputed')
+    else:
+        sys.exit('usage: python stats.py check|repair')